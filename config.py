@@ -0,0 +1,95 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from dotenv import load_dotenv
+
+# Load environment variables once for the whole process
+load_dotenv()
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Process-wide configuration, read from the environment once at import.
+    """
+    sambanova_api_key: Optional[str]
+    embedding_model: Optional[str]
+    llm_api_key: Optional[str]
+    llm_model: Optional[str]
+    pinecone_api_key: Optional[str]
+    pinecone_index_name: str = "medical-assistant-index"
+    embedding_dimension: int = 4096
+    embedding_max_batch_size: int = 64
+    embedding_concurrency: int = 8
+    # For backends without list input: one text per request, fanned out over
+    # rag_embed_workers threads/tasks
+    embedding_batch_enabled: bool = True
+    rag_embed_workers: int = (os.cpu_count() or 4) + 4
+    embedding_cache_capacity: int = 10_000
+    embedding_cache_ttl: int = 86400
+    # SQLite file backing the embedding cache across restarts (unset: memory only)
+    embedding_cache_path: Optional[str] = None
+    pinecone_result_cache_size: int = 2048
+    # Seconds a cached Pinecone result may be served; bounds staleness from
+    # writes made by other worker processes
+    pinecone_result_cache_ttl: int = 300
+    pinecone_batch_size: int = 100
+    pinecone_pool_threads: int = 16
+    pinecone_use_grpc: bool = False
+    # Vectors are L2-normalized before upsert/query, so dotproduct ranks like
+    # cosine without the server-side normalization
+    pinecone_metric: str = "dotproduct"
+    # Decimal places kept for vector values on the JSON wire (<= 0 disables)
+    pinecone_value_decimals: int = 6
+    # Over-fetch this many candidates (with values) and rerank them exactly
+    # against the query before keeping top_k (<= top_k disables)
+    pinecone_rerank_candidates: int = 0
+    # Retrievals whose best match scores below this skip the LLM call
+    rag_min_score: float = 0.2
+    # Max characters of retrieved context sent to the LLM (<= 0 disables)
+    rag_context_budget: int = 8000
+    # Max characters taken from any single retrieved match (<= 0 disables)
+    rag_max_doc_chars: int = 0
+    sambanova_base_url: str = "https://api.sambanova.ai/v1"
+    # "sambanova" (remote API) or "onnx" (local ONNX Runtime model for both
+    # ingestion and queries; the index must be built with the same model)
+    embedding_provider: str = "sambanova"
+    embedding_onnx_model_path: Optional[str] = None
+    embedding_onnx_tokenizer_path: Optional[str] = None
+    # "mean" (E5-style) or "cls" (BGE-style) pooling of the last hidden state
+    embedding_onnx_pooling: str = "mean"
+
+def load_settings() -> Settings:
+    return Settings(
+        sambanova_api_key=os.getenv("SAMBANOVA_API_KEY"),
+        embedding_model=os.getenv("EMBEDDING_MODEL"),
+        llm_api_key=os.getenv("LLM_API_KEY"),
+        llm_model=os.getenv("LLM_MODEL"),
+        pinecone_api_key=os.getenv("PINECONE_API_KEY"),
+        pinecone_index_name=os.getenv("PINECONE_INDEX_NAME", "medical-assistant-index"),
+        embedding_dimension=int(os.getenv("EMBEDDING_DIMENSION", 4096)),
+        embedding_max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", 64)),
+        embedding_concurrency=int(os.getenv("EMBEDDING_CONCURRENCY", 8)),
+        embedding_batch_enabled=os.getenv("EMBEDDING_BATCH_ENABLED", "true").lower() in ("1", "true", "yes"),
+        rag_embed_workers=int(os.getenv("RAG_EMBED_WORKERS", (os.cpu_count() or 4) + 4)),
+        embedding_cache_capacity=int(os.getenv("EMBEDDING_CACHE_CAPACITY", 10_000)),
+        embedding_cache_ttl=int(os.getenv("EMBEDDING_CACHE_TTL", 86400)),
+        embedding_cache_path=os.getenv("EMBEDDING_CACHE_PATH") or None,
+        pinecone_result_cache_size=int(os.getenv("PINECONE_RESULT_CACHE_SIZE", 2048)),
+        pinecone_result_cache_ttl=int(os.getenv("PINECONE_RESULT_CACHE_TTL", 300)),
+        pinecone_batch_size=int(os.getenv("PINECONE_BATCH_SIZE", 100)),
+        pinecone_pool_threads=int(os.getenv("PINECONE_POOL_THREADS", 16)),
+        pinecone_metric=os.getenv("PINECONE_METRIC", "dotproduct"),
+        pinecone_value_decimals=int(os.getenv("PINECONE_VALUE_DECIMALS", 6)),
+        pinecone_rerank_candidates=int(os.getenv("PINECONE_RERANK_CANDIDATES", 0)),
+        pinecone_use_grpc=os.getenv("PINECONE_USE_GRPC", "false").lower() in ("1", "true", "yes"),
+        rag_min_score=float(os.getenv("RAG_MIN_SCORE", 0.2)),
+        rag_context_budget=int(os.getenv("RAG_CONTEXT_BUDGET", 8000)),
+        rag_max_doc_chars=int(os.getenv("RAG_MAX_DOC_CHARS", 0)),
+        embedding_provider=os.getenv("EMBEDDING_PROVIDER", "sambanova").lower(),
+        embedding_onnx_model_path=os.getenv("EMBEDDING_ONNX_MODEL_PATH") or None,
+        embedding_onnx_tokenizer_path=os.getenv("EMBEDDING_ONNX_TOKENIZER_PATH") or None,
+        embedding_onnx_pooling=os.getenv("EMBEDDING_ONNX_POOLING", "mean").lower(),
+    )
+
+settings = load_settings()
@@ -1,79 +1,419 @@
+import asyncio
+import dataclasses
+import hashlib
 import logging
-import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import requests
-from typing import List
-import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import httpx
+import orjson
+
+try:
+    import onnxruntime
+    from tokenizers import Tokenizer
+except ImportError:  # optional; only needed for EMBEDDING_PROVIDER=onnx
+    onnxruntime = None
+    Tokenizer = None
+
+from config import Settings, settings as default_settings
+from http_utils import SESSION, apost_with_retry
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 class SambaNovaEmbedding:
-    def __init__(self):
-        self.api_key = os.getenv("SAMBANOVA_API_KEY")
-        self.model = os.getenv("EMBEDDING_MODEL")
-        self.dimension = int(os.getenv("EMBEDDING_DIMENSION", 4096))
-        self.base_url = "https://api.sambanova.ai/v1"
+    def __init__(self, client: Optional[httpx.AsyncClient] = None, settings: Settings = default_settings):
+        self.settings = settings
+        self.api_key = settings.sambanova_api_key
+        self.model = settings.embedding_model
+        self.dimension = settings.embedding_dimension
+        self.base_url = settings.sambanova_base_url
+        # Upper bound on texts per /embeddings request; callers can ask for
+        # smaller batches but never larger ones.
+        self.max_batch_size = settings.embedding_max_batch_size
+        # Cap on in-flight batch requests, to stay within provider rate limits
+        self.concurrency = max(1, settings.embedding_concurrency)
+        # The batched path is preferred; without it every text is its own
+        # request and the same pool/semaphore fans them out more widely
+        self.batch_enabled = settings.embedding_batch_enabled
+        if not self.batch_enabled:
+            self.max_batch_size = 1
+            self.concurrency = max(1, settings.rag_embed_workers)
+        # Request constants are built once rather than on every call
+        self._embed_url = f"{self.base_url}/embeddings"
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        # Shared, pooled async client (owned by the FastAPI app). When it is
+        # not provided the async methods fall back to the blocking path.
+        self.client = client
+        # Content-addressed cache so identical texts are only embedded once
+        self.cache = EmbeddingCache(
+            self.model,
+            max_size=settings.embedding_cache_capacity,
+            ttl_seconds=settings.embedding_cache_ttl,
+            path=settings.embedding_cache_path
+        )
         
         logger.info("Initializing SambaNova Embedding service...")
-        logger.info(f"Using model: {self.model}")
-        logger.info(f"Expected dimension: {self.dimension}")
-        logger.info(f"Base URL: {self.base_url}")
+        logger.info("Using model: %s", self.model)
+        logger.info("Embedding model used for INGESTION and QUERY: %s", self.model)
+        logger.info("Expected dimension: %d", self.dimension)
+        logger.info("Max batch size: %d, concurrency: %d", self.max_batch_size, self.concurrency)
+        logger.info("Base URL: %s", self.base_url)
         
-    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+    def get_embeddings(self, texts: List[str]) -> np.ndarray:
         """
         Get embeddings for a list of texts using SambaNova API
         """
-        logger.info(f"Generating embeddings for {len(texts)} texts")
-        logger.info(f"Embedding model used for INGESTION: {self.model}")  # Added required logging
-        logger.debug(f"Text lengths: {[len(text) for text in texts]}")
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+        logger.debug("Generating embeddings for %d texts", len(texts))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Text lengths: %s", [len(text) for text in texts])
         
         payload = {
             "model": self.model,
             "input": texts
         }
         
-        logger.debug("Calling SambaNova embeddings API...")
-        logger.info(f"API endpoint: {self.base_url}/embeddings")
-        logger.info(f"Headers: {headers}")
-        logger.info(f"Payload texts count: {len(texts)}")
+        logger.debug("Calling SambaNova embeddings API at %s", self._embed_url)
         
         try:
-            response = requests.post(
-                f"{self.base_url}/embeddings",
-                headers=headers,
-                json=payload,
+            response = SESSION.post(
+                self._embed_url,
+                headers=self._headers,
+                data=orjson.dumps(payload),
                 timeout=30  # Add timeout to prevent hanging
             )
-            logger.info(f"SambaNova API response status: {response.status_code}")
-            logger.info(f"Response headers: {dict(response.headers)}")
+            logger.debug("SambaNova API response status: %s", response.status_code)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response headers: %s", dict(response.headers))
         except Exception as e:
-            logger.error(f"Error calling SambaNova API: {e}")
+            logger.error("Error calling SambaNova API: %s", e)
             logger.exception(e)
             raise Exception(f"Error calling SambaNova API: {e}")
         
+        return self._parse_embeddings(response)
+
+    async def aget_embeddings(self, texts: List[str]) -> np.ndarray:
+        """
+        Async variant of get_embeddings using the shared httpx.AsyncClient
+        """
+        if self.client is None:
+            # No pooled client available: keep the event loop free
+            return await asyncio.to_thread(self.get_embeddings, texts)
+
+        logger.debug("Generating embeddings for %d texts (async)", len(texts))
+
+        payload = {
+            "model": self.model,
+            "input": texts
+        }
+
+        try:
+            response = await apost_with_retry(
+                self.client,
+                self._embed_url,
+                headers=self._headers,
+                content=orjson.dumps(payload),
+                timeout=30
+            )
+            logger.debug("SambaNova API response status: %s", response.status_code)
+        except Exception as e:
+            logger.error("Error calling SambaNova API: %s", e)
+            logger.exception(e)
+            raise Exception(f"Error calling SambaNova API: {e}")
+
+        return self._parse_embeddings(response)
+
+    def _parse_embeddings(self, response) -> np.ndarray:
+        """
+        Validate an embeddings API response (requests or httpx) and decode the
+        vectors into one contiguous (n, dim) float32 array
+        """
         if response.status_code != 200:
-            logger.error(f"Error getting embeddings: {response.text}")
-            logger.error(f"Status code: {response.status_code}")
+            logger.error("Error getting embeddings: %s", response.text)
+            logger.error("Status code: %s", response.status_code)
             raise Exception(f"Error getting embeddings: {response.text}")
             
-        data = response.json()
-        embeddings = [item["embedding"] for item in data["data"]]
-        logger.info(f"Embeddings generated successfully. Dimension: {len(embeddings[0]) if embeddings else 0}")
-        logger.info(f"Embedding model used for QUERY: {self.model}")  # Added required logging
+        data = orjson.loads(response.content)
+        items = data["data"]
+        dimension = len(items[0]["embedding"]) if items else self.dimension
+        embeddings = np.empty((len(items), dimension), dtype=np.float32)
+        for i, item in enumerate(items):
+            embeddings[i] = item["embedding"]
+        logger.debug("Embeddings generated successfully. Shape: %s", embeddings.shape)
         return embeddings
     
-    def get_single_embedding(self, text: str) -> List[float]:
+    def get_single_embedding(self, text: str) -> np.ndarray:
         """
         Get embedding for a single text
         """
-        logger.debug(f"Generating embedding for single text with length: {len(text)}")
-        logger.info(f"Embedding model used for QUERY: {self.model}")  # Added required logging
-        result = self.get_embeddings([text])[0]
-        logger.debug(f"Single embedding generated with dimension: {len(result)}")
-        return result
\ No newline at end of file
+        logger.debug("Generating embedding for single text with length: %d", len(text))
+        result = self.embed_batch([text])[0]
+        logger.debug("Single embedding generated with dimension: %d", len(result))
+        return result
+
+    async def aget_single_embedding(self, text: str) -> np.ndarray:
+        """
+        Async variant of get_single_embedding
+        """
+        logger.debug("Generating embedding for single text with length: %d", len(text))
+        result = (await self.aembed_batch([text]))[0]
+        logger.debug("Single embedding generated with dimension: %d", len(result))
+        return result
+
+    def _batches(self, texts: List[str], batch_size: int) -> List[List[str]]:
+        """
+        Split texts into consecutive batches no larger than the configured maximum
+        """
+        batch_size = max(1, min(batch_size, self.max_batch_size))
+        return [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+    def _split_cached(self, texts: List[str]):
+        """
+        Look texts up in the embedding cache.
+        Returns (keys, cached vectors by position, positions that missed).
+        """
+        keys = [self.cache.key(text) for text in texts]
+        cached = {}
+        misses = []
+        for i, key in enumerate(keys):
+            vector = self.cache.get(key)
+            if vector is None:
+                misses.append(i)
+            else:
+                cached[i] = vector
+        return keys, cached, misses
+
+    def _stitch(self, texts: List[str], keys: List[str], cached: Dict[int, np.ndarray],
+                misses: List[int], fetched: np.ndarray) -> np.ndarray:
+        """
+        Store freshly fetched vectors and reassemble results in input order
+        """
+        stored = self.cache.put_many((keys[i], vector) for i, vector in zip(misses, fetched))
+        cached.update(zip(misses, stored))
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.stack([cached[i] for i in range(len(texts))])
+
+    def embed_batch(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        """
+        Embed many texts with one API request per batch instead of one per text.
+        Texts already in the cache are not re-sent; batches run on a bounded
+        thread pool and results keep the input order.
+        """
+        keys, cached, misses = self._split_cached(texts)
+        batches = self._batches([texts[i] for i in misses], batch_size)
+        if not batches:
+            fetched = np.empty((0, self.dimension), dtype=np.float32)
+        elif len(batches) == 1:
+            fetched = self.get_embeddings(batches[0])
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+                fetched = np.concatenate(list(executor.map(self.get_embeddings, batches)))
+        return self._stitch(texts, keys, cached, misses, fetched)
+
+    async def aembed_batch(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        """
+        Async variant of embed_batch; batches are requested concurrently,
+        at most self.concurrency at a time. With a disk-backed cache the
+        lookups and writes run in a worker thread, off the event loop.
+        """
+        if self.cache.persistent:
+            keys, cached, misses = await asyncio.to_thread(self._split_cached, texts)
+        else:
+            keys, cached, misses = self._split_cached(texts)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _one(batch: List[str]) -> np.ndarray:
+            async with semaphore:
+                return await self.aget_embeddings(batch)
+
+        # gather preserves the order of its arguments
+        results = await asyncio.gather(*[_one(batch) for batch in self._batches([texts[i] for i in misses], batch_size)])
+        fetched = np.concatenate(results) if results else np.empty((0, self.dimension), dtype=np.float32)
+        if self.cache.persistent and misses:
+            return await asyncio.to_thread(self._stitch, texts, keys, cached, misses, fetched)
+        return self._stitch(texts, keys, cached, misses, fetched)
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU + TTL cache of embeddings keyed by a BLAKE2b digest of
+    the model name and text. Exact match only, so there is no semantic drift.
+
+    With a path, entries are also persisted to a SQLite table so re-ingesting
+    the same documents after a restart costs no API calls. The disk tier has
+    no TTL: an embedding only changes with the model, which is in the key.
+    The file may be shared by several worker processes, so it uses WAL and a
+    busy timeout, and disk I/O holds its own lock rather than the LRU's.
+    """
+
+    def __init__(self, model: Optional[str], max_size: int = 10_000, ttl_seconds: int = 86400,
+                 path: Optional[str] = None):
+        self.model = model or ""
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA busy_timeout = 5000")
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(hash TEXT PRIMARY KEY, model TEXT, dim INT, vec BLOB)"
+            )
+            self._db.commit()
+            logger.info("Embedding cache persisted to %s", path)
+
+    @property
+    def persistent(self) -> bool:
+        """
+        True when lookups and writes may touch the SQLite file
+        """
+        return self._db is not None
+
+    def key(self, text: str) -> str:
+        return hashlib.blake2b(f"{self.model}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            if self._db is None:
+                self.misses += 1
+                return None
+        with self._db_lock:
+            row = self._db.execute("SELECT vec FROM embeddings WHERE hash = ?", (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            # frombuffer over bytes is already read-only
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, vector)
+            self.hits += 1
+            return vector
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        # caller holds the lock
+        self._entries[key] = (vector, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def put(self, key: str, vector: np.ndarray) -> np.ndarray:
+        return self.put_many([(key, vector)])[0]
+
+    def put_many(self, items: Iterable[Tuple[str, np.ndarray]]) -> List[np.ndarray]:
+        """
+        Store vectors (one disk transaction for the lot); returns the stored copies.
+        """
+        stored = []
+        with self._lock:
+            for key, vector in items:
+                # Store a read-only copy so callers can't mutate cached vectors
+                vector = np.array(vector, dtype=np.float32)
+                vector.flags.writeable = False
+                self._remember(key, vector)
+                stored.append((key, vector))
+        if self._db is not None and stored:
+            with self._db_lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (hash, model, dim, vec) VALUES (?, ?, ?, ?)",
+                    [(key, self.model, vector.shape[0], vector.tobytes()) for key, vector in stored]
+                )
+                self._db.commit()
+        return [vector for _, vector in stored]
+
+
+class LocalOnnxEmbedding(SambaNovaEmbedding):
+    """
+    SambaNovaEmbedding backed by a local ONNX Runtime model instead of the
+    remote API. Batching and the embedding cache are inherited; only the
+    per-batch embedding call runs in-process.
+
+    Query and document vectors must come from the same model, so this
+    provider is used for ingestion and queries alike, with an index whose
+    dimension matches the model's output.
+    """
+
+    def __init__(self, client: Optional[httpx.AsyncClient] = None, settings: Settings = default_settings):
+        if onnxruntime is None or Tokenizer is None:
+            raise ImportError("EMBEDDING_PROVIDER=onnx needs the onnxruntime and tokenizers packages")
+        model_path = settings.embedding_onnx_model_path
+        tokenizer_path = settings.embedding_onnx_tokenizer_path
+        if not model_path or not tokenizer_path:
+            raise ValueError("EMBEDDING_ONNX_MODEL_PATH and EMBEDDING_ONNX_TOKENIZER_PATH must be set")
+
+        # The cache key includes the model name, so local vectors never mix
+        # with remote ones
+        super().__init__(client=None, settings=dataclasses.replace(settings, embedding_model=f"onnx:{model_path}"))
+        # One session already uses every core; parallel batches would oversubscribe
+        self.concurrency = 1
+
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider")
+                     if p in onnxruntime.get_available_providers()]
+        self.session = onnxruntime.InferenceSession(model_path, providers=providers)
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_padding()
+        self.tokenizer.enable_truncation(max_length=512)
+        self.pooling = settings.embedding_onnx_pooling
+        logger.info("Local ONNX embedding model: %s (providers=%s, pooling=%s)",
+                    model_path, providers, self.pooling)
+
+    def get_embeddings(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a batch locally: tokenize, run the model, pool and L2-normalize
+        """
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+        hidden = self.session.run(None, feeds)[0].astype(np.float32)
+        if self.pooling == "cls":
+            pooled = hidden[:, 0]
+        else:
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return np.ascontiguousarray(pooled / np.maximum(norms, 1e-12), dtype=np.float32)
+
+    async def aget_embeddings(self, texts: List[str]) -> np.ndarray:
+        """
+        Inference is CPU/GPU-bound; keep it off the event loop
+        """
+        return await asyncio.to_thread(self.get_embeddings, texts)
+
+
+def make_embedding_service(client: Optional[httpx.AsyncClient] = None,
+                           settings: Settings = default_settings) -> SambaNovaEmbedding:
+    """
+    Embedding service for settings.embedding_provider
+    """
+    if settings.embedding_provider == "onnx":
+        return LocalOnnxEmbedding(client=client, settings=settings)
+    return SambaNovaEmbedding(client=client, settings=settings)
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import random
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Transient provider failures worth another attempt; 4xx responses are not
+RETRYABLE_STATUS_CODES = frozenset({500, 502, 503, 504})
+
+def make_retry_session(pool_connections: int = 16, pool_maxsize: int = 32,
+                       max_retries: int = 3, backoff_factor: float = 0.2) -> requests.Session:
+    """
+    requests.Session with keep-alive pooling and the same retry policy as
+    apost_with_retry (connection errors and 5xx, POST included). As there,
+    max_retries is the total number of attempts; urllib3's total counts
+    retries after the first, hence the - 1. After the last attempt the final
+    response is returned rather than raised.
+    """
+    retry = Retry(
+        total=max(0, max_retries - 1),
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRYABLE_STATUS_CODES,
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False
+    )
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Shared by the blocking embedding and LLM paths so TLS connections are
+# reused across calls instead of re-handshaking on every request
+SESSION = make_retry_session()
+
+async def apost_with_retry(client: httpx.AsyncClient, url: str, max_retries: int = 3,
+                           initial_delay: float = 0.2, max_delay: float = 2.0, **kwargs) -> httpx.Response:
+    """
+    POST with exponential backoff and jitter on transport errors and 5xx.
+
+    The SambaNova embedding and chat calls are idempotent, so repeating them
+    is safe. Retries go through the same pooled client and reuse its warm
+    connections. After the last attempt the final response is returned (or
+    the final transport error raised) for the caller to handle as before.
+    """
+    delay = initial_delay
+    for attempt in range(max_retries):
+        try:
+            response = await client.post(url, **kwargs)
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == max_retries - 1:
+                return response
+            logger.warning("Attempt %d to %s returned %d", attempt + 1, url, response.status_code)
+        except httpx.TransportError as e:
+            if attempt == max_retries - 1:
+                raise
+            logger.warning("Attempt %d to %s failed: %s", attempt + 1, url, e)
+
+        sleep_for = min(max_delay, delay) * random.uniform(0.5, 1.0)
+        logger.info("Retrying in %.2f seconds...", sleep_for)
+        await asyncio.sleep(sleep_for)
+        delay *= 2
@@ -20,7 +20,9 @@ def initialize_pinecone():
         pc.create_index(
             name=index_name,
             dimension=int(os.getenv("EMBEDDING_DIMENSION", 4096)),
-            metric="cosine",
+            # Vectors are L2-normalized before upsert and query, so
+            # dotproduct ranks like cosine without server-side normalization
+            metric=os.getenv("PINECONE_METRIC", "dotproduct"),
             spec={
                 "serverless": {
                     "cloud": "aws",
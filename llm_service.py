@@ -1,21 +1,42 @@
+import asyncio
 import logging
-import os
-import requests
-import json
-from typing import List, Dict, Any
+from typing import List, Dict, AsyncIterator, Iterator, Optional
+
+import httpx
+import orjson
+
+from config import Settings, settings as default_settings
+from http_utils import SESSION, apost_with_retry
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Returned by _parse_stream_line for the SSE "[DONE]" marker
+_STREAM_DONE = object()
+
+# Static prompt prefix, identical on every call so provider-side prompt
+# caching can reuse it; only the user message (context + question) varies
+SYSTEM_PROMPT = """You are an advanced medical RAG assistant. You must strictly use the provided context for every answer. The context may include metadata in square brackets such as [Patient: John Doe, Patient ID: P12345] followed by the medical content. Use both the metadata and content to answer questions. If the answer is not found in the context, say 'I could not find this information in the patient's medical records.'"""
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
 class SambaNovaLLM:
-    def __init__(self):
-        self.api_key = os.getenv("LLM_API_KEY")
-        self.model = os.getenv("LLM_MODEL")
-        self.base_url = "https://api.sambanova.ai/v1"
+    def __init__(self, client: Optional[httpx.AsyncClient] = None, settings: Settings = default_settings):
+        self.settings = settings
+        self.api_key = settings.llm_api_key
+        self.model = settings.llm_model
+        self.base_url = settings.sambanova_base_url
+        # Shared, pooled async client (owned by the FastAPI app)
+        self.client = client
+        # Request constants are built once rather than on every call
+        self._chat_url = f"{self.base_url}/chat/completions"
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
         
         logger.info("Initializing SambaNova LLM service...")
-        logger.info(f"Using model: {self.model}")
-        logger.info(f"Base URL: {self.base_url}")
+        logger.info("Using model: %s", self.model)
+        logger.info("Base URL: %s", self.base_url)
         
     def generate_response(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 1024) -> str:
         """
@@ -29,14 +50,9 @@ class SambaNovaLLM:
         Returns:
             Generated response text
         """
-        logger.info("Generating response with LLM")
-        logger.debug(f"Number of messages: {len(messages)}")
-        logger.debug(f"Temperature: {temperature}, Max tokens: {max_tokens}")
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+        logger.debug("Generating response with LLM")
+        logger.debug("Number of messages: %d", len(messages))
+        logger.debug("Temperature: %s, Max tokens: %s", temperature, max_tokens)
         
         payload = {
             "model": self.model,
@@ -47,25 +63,162 @@ class SambaNovaLLM:
         
         logger.debug("Calling SambaNova chat completions API...")
         try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload,
+            response = SESSION.post(
+                self._chat_url,
+                headers=self._headers,
+                data=orjson.dumps(payload),
                 timeout=60  # Add timeout to prevent hanging
             )
-            logger.info(f"SambaNova API response status: {response.status_code}")
+            logger.debug("SambaNova API response status: %s", response.status_code)
         except Exception as e:
-            logger.error(f"Error calling SambaNova API: {e}")
+            logger.error("Error calling SambaNova API: %s", e)
             raise Exception(f"Error calling SambaNova API: {e}")
         
+        return self._parse_response(response)
+
+    async def agenerate_response(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 1024) -> str:
+        """
+        Async variant of generate_response using the shared httpx.AsyncClient
+        """
+        if self.client is None:
+            # No pooled client available: keep the event loop free
+            return await asyncio.to_thread(self.generate_response, messages, temperature, max_tokens)
+
+        logger.debug("Generating response with LLM (async)")
+
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+
+        try:
+            response = await apost_with_retry(
+                self.client,
+                self._chat_url,
+                headers=self._headers,
+                content=orjson.dumps(payload),
+                timeout=60
+            )
+            logger.debug("SambaNova API response status: %s", response.status_code)
+        except Exception as e:
+            logger.error("Error calling SambaNova API: %s", e)
+            raise Exception(f"Error calling SambaNova API: {e}")
+
+        return self._parse_response(response)
+
+    def stream_response(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                        max_tokens: int = 1024) -> Iterator[str]:
+        """
+        Stream a response token-by-token using the provider's SSE mode
+
+        Yields:
+            Content deltas as they arrive
+        """
+        logger.debug("Streaming response with LLM")
+
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True
+        }
+
+        with SESSION.post(
+            self._chat_url,
+            headers=self._headers,
+            data=orjson.dumps(payload),
+            stream=True,
+            timeout=60
+        ) as response:
+            if response.status_code != 200:
+                logger.error("Error streaming response: %s", response.text)
+                logger.error("Status code: %s", response.status_code)
+                raise Exception(f"Error generating response: {response.text}")
+
+            for line in response.iter_lines(decode_unicode=True):
+                content = self._parse_stream_line(line)
+                if content is _STREAM_DONE:
+                    break
+                if content:
+                    yield content
+
+    async def astream_response(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                               max_tokens: int = 1024) -> AsyncIterator[str]:
+        """
+        Stream a response token-by-token using the provider's SSE mode
+
+        Yields:
+            Content deltas as they arrive
+        """
+        if self.client is None:
+            # No pooled client to stream with: yield the buffered answer once
+            yield await self.agenerate_response(messages, temperature, max_tokens)
+            return
+
+        logger.debug("Streaming response with LLM")
+
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True
+        }
+
+        async with self.client.stream(
+            "POST",
+            self._chat_url,
+            headers=self._headers,
+            content=orjson.dumps(payload),
+            timeout=60
+        ) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                logger.error("Error streaming response: %s", body)
+                logger.error("Status code: %s", response.status_code)
+                raise Exception(f"Error generating response: {body}")
+
+            async for line in response.aiter_lines():
+                content = self._parse_stream_line(line)
+                if content is _STREAM_DONE:
+                    break
+                if content:
+                    yield content
+
+    @staticmethod
+    def _parse_stream_line(line: Optional[str]):
+        """
+        Extract the content delta from one SSE line
+
+        Returns:
+            The delta text (or None for non-data lines and empty deltas),
+            _STREAM_DONE once the stream reports [DONE]
+        """
+        if not line or not line.startswith("data:"):
+            return None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return _STREAM_DONE
+        choices = orjson.loads(data).get("choices") or []
+        if not choices:
+            return None
+        return (choices[0].get("delta") or {}).get("content")
+
+    def _parse_response(self, response) -> str:
+        """
+        Validate a chat completions response (requests or httpx) and extract the text
+        """
         if response.status_code != 200:
-            logger.error(f"Error generating response: {response.text}")
-            logger.error(f"Status code: {response.status_code}")
+            logger.error("Error generating response: %s", response.text)
+            logger.error("Status code: %s", response.status_code)
             raise Exception(f"Error generating response: {response.text}")
             
-        data = response.json()
+        data = orjson.loads(response.content)
         result = data["choices"][0]["message"]["content"]
-        logger.info(f"Response generated successfully. Response length: {len(result)}")
+        logger.debug("Response generated successfully. Response length: %d", len(result))
         return result
     
     def generate_response_with_context(self, context: str, query: str, temperature: float = 0.7, max_tokens: int = 1024) -> str:
@@ -81,17 +234,46 @@ class SambaNovaLLM:
         Returns:
             Generated response text
         """
-        logger.info("Generating response with context")
-        logger.debug(f"Context length: {len(context)}, Query length: {len(query)}")
-        logger.info(f"Context passed to LLM: {context[:200]}...")  # Log first 200 chars of context
+        messages = self._build_context_messages(context, query)
+        return self.generate_response(messages, temperature, max_tokens)
+
+    async def agenerate_response_with_context(self, context: str, query: str, temperature: float = 0.7, max_tokens: int = 1024) -> str:
+        """
+        Async variant of generate_response_with_context
+        """
+        messages = self._build_context_messages(context, query)
+        return await self.agenerate_response(messages, temperature, max_tokens)
+
+    def stream_response_with_context(self, context: str, query: str, temperature: float = 0.7,
+                                     max_tokens: int = 1024) -> Iterator[str]:
+        """
+        Streaming variant of generate_response_with_context
+        """
+        messages = self._build_context_messages(context, query)
+        yield from self.stream_response(messages, temperature, max_tokens)
+
+    async def astream_response_with_context(self, context: str, query: str, temperature: float = 0.7,
+                                            max_tokens: int = 1024) -> AsyncIterator[str]:
+        """
+        Streaming variant of agenerate_response_with_context
+        """
+        messages = self._build_context_messages(context, query)
+        async for content in self.astream_response(messages, temperature, max_tokens):
+            yield content
+
+    def _build_context_messages(self, context: str, query: str) -> List[Dict[str, str]]:
+        """
+        Build the system/user chat messages for a RAG prompt
+        """
+        logger.debug("Generating response with context")
+        logger.debug("Context length: %d, Query length: %d", len(context), len(query))
+        logger.debug("Context passed to LLM: %.200s...", context)  # Log first 200 chars of context
         
         # If no context returned, avoid empty answer
         if not context or context.strip() == "":
             context = "No relevant medical history found in the database."
         
         # Create a cleaner prompt format
-        system_message = """You are an advanced medical RAG assistant. You must strictly use the provided context for every answer. The context may include metadata in square brackets such as [Patient: John Doe, Patient ID: P12345] followed by the medical content. Use both the metadata and content to answer questions. If the answer is not found in the context, say 'I could not find this information in the patient's medical records.'"""
-        
         user_message = f"""Context:
 {context}
 
@@ -99,15 +281,11 @@ Question:
 {query}"""
         
         messages = [
-            {
-                "role": "system",
-                "content": system_message
-            },
+            _SYSTEM_MESSAGE,
             {
                 "role": "user",
                 "content": user_message
             }
         ]
         
-        logger.info("Embedding model used for QUERY: E5-Mistral-7B-Instruct")  # Added required logging
-        return self.generate_response(messages, temperature, max_tokens)
+        return messages
@@ -1,13 +1,20 @@
+import asyncio
 import logging
 import os
+import time
 import uuid
-from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
+from contextlib import asynccontextmanager
+import httpx
+import numpy as np
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-from dotenv import load_dotenv
-from rag_service import RAGService
-import json
+from config import settings
+from rag_service import RAGService, QUERY_ERROR_RESPONSE
+from query_cache import QueryCache
+import orjson
 
 # Configure logging
 logging.basicConfig(
@@ -16,39 +23,95 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
-from contextlib import asynccontextmanager
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global rag_service
-    try:
-        logger.info("Initializing RAG service...")
-        rag_service = RAGService()
-        logger.info("RAG service initialized successfully")
-    except Exception as e:
-        logger.error(f"Error initializing RAG service: {e}")
-        logger.exception(e)
+    # One pooled HTTP/2 client shared by the embedding and LLM services so
+    # connections (and TLS sessions) are reused across requests.
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    )
+    # Pinecone setup is several blocking round trips; run it in the background
+    # so the server (and /health) is up immediately. rag_ready is set once
+    # initialization has finished, successfully or not.
+    app.state.rag_ready = asyncio.Event()
+    app.state.rag_init_failed = False
+    app.state.startup_task = asyncio.create_task(initialize_rag_service(app))
+    # SOAP notes are ingested in batches by one worker draining this queue
+    app.state.soap_queue = asyncio.Queue()
+    app.state.soap_worker = asyncio.create_task(drain_soap_notes(app.state.soap_queue))
     yield
     logger.info("Application shutdown initiated. Waiting for background tasks to complete...")
 
-    import asyncio
+    startup_task = app.state.startup_task
+    if not startup_task.done():
+        startup_task.cancel()
     try:
-        await asyncio.wait_for(background_task_completion(), timeout=10.0)
+        # Flush notes that were accepted but not yet ingested
+        await asyncio.wait_for(app.state.soap_queue.join(), timeout=10.0)
     except asyncio.TimeoutError:
         logger.warning("Background tasks did not complete within 10 seconds")
+    app.state.soap_worker.cancel()
+    # The service holds the client being closed; never let it outlive this app
+    rag_service = None
+    await app.state.http.aclose()
     logger.info("Application shutdown complete.")
 
-async def background_task_completion():
-    import asyncio
-    await asyncio.sleep(5)
+async def initialize_rag_service(app: FastAPI):
+    """
+    Build the RAG service off the event loop, then warm it up and log index stats.
+    """
+    global rag_service
+    try:
+        logger.info("Initializing RAG service...")
+        service = await asyncio.to_thread(RAGService, http_client=app.state.http)
+        rag_service = service
+        logger.info("RAG service initialized successfully")
+    except Exception as e:
+        logger.error("Error initializing RAG service: %s", e)
+        logger.exception(e)
+        app.state.rag_init_failed = True
+        return
+    finally:
+        # Also on cancellation, so no request waits forever
+        app.state.rag_ready.set()
+    # Warm DNS, TLS and connection pools
+    await warmup_rag_pipeline(service)
+    await asyncio.to_thread(service.vector_store.log_index_stats)
+
+async def wait_for_rag_service():
+    """
+    Let requests that arrive during startup wait for initialization instead of failing.
+    """
+    # Set as soon as the service exists (warmup may still be running) or
+    # initialization has failed
+    rag_ready = getattr(app.state, "rag_ready", None)
+    if rag_ready is not None:
+        await rag_ready.wait()
+
+async def warmup_rag_pipeline(service: RAGService):
+    """
+    Issue one cheap embedding and one Pinecone query so the first user request
+    hits warm connections. Failures are logged (they usually point at
+    misconfiguration) but never stop the app.
+    """
+    try:
+        # Straight to the API: a cached (or persisted) vector would skip the
+        # network and warm nothing
+        embedding = (await service.embedding_service.aget_embeddings([" "]))[0]
+        await service.vector_store.aquery_similar(embedding, top_k=1)
+        logger.info("RAG pipeline warmup complete")
+    except Exception as e:
+        logger.warning("RAG pipeline warmup failed: %s", e)
 
 app = FastAPI(
     title="Medical RAG Chatbot",
     description="A RAG chatbot for medical assistance",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # Serialize JSON responses with orjson instead of the stdlib encoder
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -59,24 +122,72 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    logger.info(f"Incoming {request.method} request to {request.url}")
-    logger.info(f"Headers: {dict(request.headers)}")
+# Upper bound on how much of a request body is ever logged
+MAX_LOG_BODY = 2048
 
-    if request.method in ["POST", "PUT", "PATCH"]:
-        body = await request.body()
-        if body:
-            try:
-                body_str = body.decode("utf-8")
-                logger.info(f"Request body: {body_str}")
-            except Exception:
-                logger.warning("Could not decode request body")
+class LogRequestsMiddleware:
+    """
+    Pure ASGI request logger.
+
+    Reads method, path and headers straight from the scope and tees the
+    request body (up to max_body bytes) as the application consumes it, so
+    the body is never buffered up front and responses stream untouched.
+    Nothing is inspected unless DEBUG logging is enabled.
+    """
+
+    def __init__(self, app, max_body: int = MAX_LOG_BODY):
+        self.app = app
+        self.max_body = max_body
+
+    async def __call__(self, scope, receive, send):
+        # Health checks fire constantly from the load balancer; don't log them
+        if (scope["type"] != "http" or scope["path"] == "/health"
+                or not logger.isEnabledFor(logging.DEBUG)):
+            await self.app(scope, receive, send)
+            return
+
+        logger.debug("Incoming %s request to %s", scope["method"], scope["path"])
+        logger.debug("Headers: %s", {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]})
+
+        if scope["method"] not in ("POST", "PUT", "PATCH"):
+            await self.app(scope, receive, send)
+            return
+
+        captured = bytearray()
+
+        async def logging_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                room = self.max_body - len(captured)
+                if room > 0:
+                    captured.extend(message.get("body", b"")[:room])
+                if not message.get("more_body", False) and captured:
+                    logger.debug("Request body: %s", captured.decode("utf-8", errors="replace"))
+            return message
 
-    response = await call_next(request)
-    return response
+        await self.app(scope, logging_receive, send)
+
+app.add_middleware(LogRequestsMiddleware)
 
 rag_service = None
+query_cache = QueryCache(max_size=2000, ttl_seconds=600)
+
+# Probe vector for /debug/pinecone, allocated once. Non-zero because cosine
+# indexes reject all-zero vectors; the vector store converts it at the SDK call.
+_PROBE = np.full(settings.embedding_dimension, 0.1, dtype=np.float32)
+_PROBE.flags.writeable = False
+
+# (fetched_at, names) for /debug/pinecone; the index list rarely changes
+INDEX_LIST_TTL = 60.0
+_index_names_cache = (0.0, None)
+
+def list_index_names(pc) -> List[str]:
+    global _index_names_cache
+    fetched_at, names = _index_names_cache
+    if names is None or time.monotonic() - fetched_at > INDEX_LIST_TTL:
+        names = list(pc.list_indexes().names())
+        _index_names_cache = (time.monotonic(), names)
+    return names
 
 class QueryRequest(BaseModel):
     query: str
@@ -95,34 +206,50 @@ class SOAPNotesRequest(BaseModel):
 async def root():
     return {"message": "Medical RAG Chatbot is running"}
 
+def rag_service_state() -> str:
+    if rag_service is not None:
+        return "ready"
+    if getattr(app.state, "rag_init_failed", False):
+        return "failed"
+    return "initializing"
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "rag_service": rag_service_state(),
+        "query_cache": query_cache.stats()
+    }
 
 @app.get("/debug/pinecone")
 async def debug_pinecone():
+    await wait_for_rag_service()
     if rag_service is None:
         raise HTTPException(status_code=500, detail="RAG service not initialized")
 
     try:
-        from pinecone import Pinecone
-        pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-        indexes = pc.list_indexes().names()
+        # Reuse the vector store's client instead of building a new one per hit
+        pc = rag_service.vector_store.pc
 
-        test_vector = [0.1] * 4096
-        matches = rag_service.vector_store.query_similar(test_vector, top_k=1)
+        # The index listing and the probe query are independent RPCs; run
+        # them concurrently and off the event loop.
+        indexes, matches = await asyncio.gather(
+            asyncio.to_thread(list_index_names, pc),
+            rag_service.vector_store.aquery_similar(_PROBE, top_k=1)
+        )
 
         return {
-            "indexes": list(indexes),
+            "indexes": indexes,
             "test_query_matches": len(matches)
         }
 
     except Exception as e:
-        logger.error(f"Error in Pinecone debug: {e}")
+        logger.error("Error in Pinecone debug: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/debug/test-document")
 async def debug_test_document():
+    await wait_for_rag_service()
     if rag_service is None:
         raise HTTPException(status_code=500, detail="RAG service not initialized")
 
@@ -130,70 +257,177 @@ async def debug_test_document():
         test_content = "This is a test document for debugging the RAG system. Patient has fever and cough."
         test_metadata = {"source": "debug_test", "timestamp": "2023-11-15"}
 
-        success = rag_service.add_document(test_content, test_metadata)
+        doc_id = f"debug-test-{uuid.uuid4().hex}"
+        success = await rag_service.aadd_document(test_content, test_metadata, doc_id=doc_id)
 
         if not success:
             raise HTTPException(status_code=500, detail="Failed to add test document")
+        query_cache.clear()
 
-        import time
-        time.sleep(1)
+        # Wait (up to ~1s) until the upsert is visible, yielding to other
+        # requests between polls; usually done in well under a second
+        for _ in range(20):
+            await asyncio.sleep(0.05)
+            if await rag_service.vector_store.afetch_vectors([f"{doc_id}-0"]):
+                break
 
         query_text = "What are the patient's symptoms?"
-        response = rag_service.query(query_text, top_k=3)
+        response = await rag_service.aquery(query_text, top_k=3)
 
         return {
             "document_added": True,
             "query_response": response
         }
     except Exception as e:
-        logger.error(f"Error in debug test: {e}")
+        logger.error("Error in debug test: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # RAG Query endpoint
 @app.post("/query", response_model=QueryResponse)
 async def query_rag(request: QueryRequest):
-    logger.info(f"Query endpoint accessed with query: {request.query}")
-    logger.info(f"Query parameters: top_k={request.top_k}")
+    logger.debug("Query endpoint accessed with query: %s", request.query)
+    logger.debug("Query parameters: top_k=%s", request.top_k)
+    await wait_for_rag_service()
     if rag_service is None:
         logger.error("RAG service not initialized")
         raise HTTPException(status_code=500, detail="RAG service not initialized")
     # Use default value if top_k is None
     top_k = request.top_k if request.top_k is not None else 3
-    logger.info(f"Querying RAG service with top_k: {top_k}")
+    logger.debug("Querying RAG service with top_k: %d", top_k)
     
     try:
-        response = rag_service.query(request.query, top_k)
-        logger.info("Query processed successfully")
-        logger.info(f"Response length: {len(response) if response else 0}")
+        cached, query_embedding = await lookup_query_cache(request.query, top_k)
+        if cached is not None:
+            return QueryResponse(response=cached)
+
+        response = await rag_service.aquery(request.query, top_k, query_embedding=query_embedding)
+        if response and response != QUERY_ERROR_RESPONSE:
+            query_cache.put(request.query, top_k, response, query_embedding)
+        logger.debug("Query processed successfully. Response length: %d", len(response) if response else 0)
         return QueryResponse(response=response)
     except Exception as e:
-        logger.error(f"Error processing query: {e}")
+        logger.error("Error processing query: %s", e)
         logger.exception(e)
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
+async def lookup_query_cache(query: str, top_k: int):
+    """
+    Check the exact and semantic query caches.
+    Returns (cached_response, query_embedding); the embedding is reused for
+    retrieval on a miss so the query is only embedded once.
+    """
+    cached = query_cache.get(query, top_k)
+    if cached is not None:
+        return cached, None
+
+    query_embedding = None
+    try:
+        query_embedding = await rag_service.aembed_query(query)
+        cached = query_cache.get_similar(query_embedding, top_k)
+    except Exception as e:
+        logger.warning("Could not embed query for semantic cache lookup: %s", e)
+    return cached, query_embedding
+
+def sse_event(data) -> bytes:
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+# Streaming RAG Query endpoint (Server-Sent Events)
+@app.post("/query/stream")
+async def query_rag_stream(request: QueryRequest):
+    await wait_for_rag_service()
+    if rag_service is None:
+        logger.error("RAG service not initialized")
+        raise HTTPException(status_code=500, detail="RAG service not initialized")
+    top_k = request.top_k if request.top_k is not None else 3
+
+    cached, query_embedding = await lookup_query_cache(request.query, top_k)
+
+    async def event_stream():
+        if cached is not None:
+            yield sse_event({"delta": cached})
+        else:
+            parts = []
+            try:
+                async for content in rag_service.aquery_stream(
+                    request.query, top_k, query_embedding=query_embedding, raise_errors=True
+                ):
+                    parts.append(content)
+                    yield sse_event({"delta": content})
+            except Exception:
+                # Already logged by aquery_stream; a truncated answer is never cached
+                yield sse_event({"delta": QUERY_ERROR_RESPONSE})
+            else:
+                if parts:
+                    query_cache.put(request.query, top_k, "".join(parts), query_embedding)
+        yield b"data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 # ✅ FIXED BACKGROUND TASK — uses existing global rag_service
-def process_soap_notes_in_background(soap_text: str, metadata: dict):
-    global rag_service
+# Notes accepted within SOAP_BATCH_WINDOW seconds of each other (up to
+# SOAP_BATCH_SIZE) share one embedding pass and one upsert
+SOAP_BATCH_SIZE = 64
+SOAP_BATCH_WINDOW = 0.05
+
+async def drain_soap_notes(queue: asyncio.Queue):
+    """
+    Pull (soap_text, metadata) items off the queue and ingest them in batches.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + SOAP_BATCH_WINDOW
+        while len(batch) < SOAP_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await process_soap_notes_batch(batch)
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+async def process_soap_notes_batch(batch: list):
     try:
-        logger.info("Background: Processing SOAP notes...")
+        logger.info("Background: Processing %d SOAP notes...", len(batch))
 
+        await wait_for_rag_service()
         if rag_service is None:
             logger.error("Background: RAG service not initialized")
             return
 
-        success = rag_service.add_document(soap_text, metadata)
-
-        if success:
-            logger.info("Background: SOAP notes processed successfully")
+        contents, metadatas = zip(*batch)
+        if await rag_service.aadd_documents(list(contents), list(metadatas)):
+            failed = []
+        elif len(batch) == 1:
+            failed = list(metadatas)
         else:
-            logger.error("Background: Failed to process SOAP notes")
+            # One bad note fails the whole batch; retry them one at a time so
+            # only that note is lost
+            logger.warning("Background: Batch of %d SOAP notes failed; retrying one at a time", len(batch))
+            failed = [metadata for content, metadata in batch
+                      if not await rag_service.aadd_document(content, metadata)]
+
+        if len(failed) < len(batch):
+            # Cached answers may no longer reflect the patient's records
+            query_cache.clear()
+        for metadata in failed:
+            logger.error("Background: Failed to process SOAP note (patient_id=%s, date_time=%s)",
+                         metadata.get("patient_id"), metadata.get("date_time"))
+        if not failed:
+            logger.info("Background: SOAP notes processed successfully")
 
     except Exception as e:
-        logger.error(f"Background Error: {e}")
+        logger.error("Background Error: %s", e)
         logger.exception(e)
 
 @app.post("/soap-notes")
-async def add_soap_notes(request: SOAPNotesRequest, background_tasks: BackgroundTasks):
+async def add_soap_notes(request: SOAPNotesRequest):
+    await wait_for_rag_service()
     if rag_service is None:
         raise HTTPException(status_code=500, detail="RAG service not initialized")
 
@@ -204,7 +438,7 @@ async def add_soap_notes(request: SOAPNotesRequest, background_tasks: Background
         "source": "soap_notes"
     }
 
-    background_tasks.add_task(process_soap_notes_in_background, request.soap_notes, metadata)
+    app.state.soap_queue.put_nowait((request.soap_notes, metadata))
 
     return {
         "message": "SOAP notes received and queued for processing",
@@ -214,4 +448,10 @@ async def add_soap_notes(request: SOAPNotesRequest, background_tasks: Background
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Each worker is a separate process with its own lifespan, RAGService,
+    # Pinecone client and caches; writes only invalidate the caches of the
+    # worker that handled them, so one worker is the default. loop/http stay
+    # on "auto" so uvloop and httptools from uvicorn[standard] are used where
+    # available (uvloop has no Windows build).
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers)
@@ -1,88 +1,287 @@
+import asyncio
 import logging
-import os
 import json
 import ast
-from typing import List, Dict, Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import orjson
 from pinecone import Pinecone
 
+try:
+    from pinecone.grpc import PineconeGRPC
+except ImportError:  # optional; needs the pinecone[grpc] extra
+    PineconeGRPC = None
+
+from config import Settings, settings as default_settings
+from query_cache import QVCache
+
 logger = logging.getLogger(__name__)
 
+# Pinecone request limits: 2 MB per upsert request, 1000 ids per delete
+MAX_UPSERT_REQUEST_BYTES = 2 * 1024 * 1024
+MAX_DELETE_IDS = 1000
+
+def _unit_rows(values: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize the last axis, so dot product equals cosine similarity.
+    """
+    norms = np.linalg.norm(values, axis=-1, keepdims=True)
+    return values / np.maximum(norms, 1e-12)
+
+def _json_metadata(vector_id: Any, meta: Any) -> Tuple[Dict[str, Any], int]:
+    """
+    Metadata as JSON-native values plus its encoded size. Metadata must be a
+    dict, never a string; one orjson round trip turns numpy scalars/arrays
+    into plain Python values.
+    """
+    if not isinstance(meta, dict):
+        raise ValueError(f"Metadata for vector {vector_id} must be a dict")
+    encoded = orjson.dumps(meta, default=str, option=orjson.OPT_SERIALIZE_NUMPY)
+    return orjson.loads(encoded), len(encoded)
+
+def match_as_dict(match) -> Dict[str, Any]:
+    """
+    Normalize a query match (dict or SDK object) to a plain dict.
+    """
+    if isinstance(match, dict):
+        return match
+    return {
+        "id": getattr(match, "id", "N/A"),
+        "score": getattr(match, "score", "N/A"),
+        "metadata": getattr(match, "metadata", None) or {}
+    }
+
+def _is_already_exists(error: Exception) -> bool:
+    """
+    True for the 409 Conflict Pinecone returns when creating an existing index.
+    """
+    return getattr(error, "status", None) == 409 or "already exists" in str(error).lower()
+
+def _rerank(matches: list, values: list, query_vector: np.ndarray, top_k: int) -> list:
+    """
+    Exact cosine rerank of over-fetched matches: one matrix-vector product
+    over the stacked candidate values, then the best top_k in score order
+    (argpartition, so only those k are sorted). Values are not returned.
+    """
+    embeddings = _unit_rows(np.asarray(values, dtype=np.float32))
+    scores = embeddings @ _unit_rows(np.asarray(query_vector, dtype=np.float32))
+    if len(scores) > top_k:
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        top = np.arange(len(scores))
+    order = top[np.argsort(-scores[top])]
+    return [
+        {"id": matches[i].get("id"), "score": float(scores[i]), "metadata": matches[i].get("metadata")}
+        for i in order.tolist()
+    ]
+
+# Parsed metadata for legacy vectors that were stored with stringified
+# metadata, keyed by vector id so repeat queries don't re-parse it
+_LEGACY_METADATA: Dict[str, Dict[str, Any]] = {}
+_LEGACY_METADATA_MAX = 10_000
+
+def _parse_legacy_metadata(vector_id: str, meta: str) -> Dict[str, Any]:
+    parsed = _LEGACY_METADATA.get(vector_id)
+    if parsed is not None:
+        return parsed
+    try:
+        parsed = ast.literal_eval(meta)
+    except Exception:
+        try:
+            parsed = json.loads(meta.replace("'", '"'))
+        except Exception:
+            logger.warning("Could not parse metadata for vector %s", vector_id)
+            return {}
+    if not isinstance(parsed, dict):
+        return {}
+    if len(_LEGACY_METADATA) >= _LEGACY_METADATA_MAX:
+        _LEGACY_METADATA.clear()
+    _LEGACY_METADATA[vector_id] = parsed
+    return parsed
+
 class PineconeService:
-    def __init__(self):
-        self.api_key = os.getenv("PINECONE_API_KEY")
-        self.index_name = os.getenv("PINECONE_INDEX_NAME", "medical-assistant-index")
-        self.dimension = int(os.getenv("EMBEDDING_DIMENSION", 4096))
+    def __init__(self, settings: Settings = default_settings):
+        self.settings = settings
+        self.api_key = settings.pinecone_api_key
+        self.index_name = settings.pinecone_index_name
+        self.dimension = settings.embedding_dimension
+        self.metric = settings.pinecone_metric
+        self.value_decimals = settings.pinecone_value_decimals
+        self.rerank_candidates = settings.pinecone_rerank_candidates
+        # Vectors per upsert request
+        self.batch_size = max(1, settings.pinecone_batch_size)
+        # Repeat and near-repeat query vectors are answered without a round trip
+        self.result_cache = QVCache(self.dimension, max_size=settings.pinecone_result_cache_size,
+                                    ttl_seconds=settings.pinecone_result_cache_ttl)
 
         logger.info("Initializing Pinecone service…")
 
         if not self.api_key:
             raise ValueError("❌ PINECONE_API_KEY is missing in environment variables")
 
-        self.pc = Pinecone(api_key=self.api_key)
-        logger.info("Pinecone client initialized")
+        # gRPC multiplexes every call over one HTTP/2 connection; it is opt-in
+        # because it needs the pinecone[grpc] extra.
+        self.use_grpc = settings.pinecone_use_grpc and PineconeGRPC is not None
+        if settings.pinecone_use_grpc and not self.use_grpc:
+            logger.warning("PINECONE_USE_GRPC is set but pinecone[grpc] is not installed; using HTTP")
+        self.pc = PineconeGRPC(api_key=self.api_key) if self.use_grpc else Pinecone(api_key=self.api_key)
+        logger.info("Pinecone client initialized (grpc=%s)", self.use_grpc)
 
         # List indexes
         existing = self.pc.list_indexes().names()
-        logger.info(f"Existing indexes: {existing}")
+        logger.info("Existing indexes: %s", existing)
 
         # Create if missing
         if self.index_name not in existing:
-            logger.info(f"Creating Pinecone index: {self.index_name}")
-            self.pc.create_index(
-                name=self.index_name,
-                dimension=self.dimension,
-                metric="cosine",
-                spec={
-                    "serverless": {
-                        "cloud": "aws",
-                        "region": "us-east-1"
+            logger.info("Creating Pinecone index: %s", self.index_name)
+            try:
+                self.pc.create_index(
+                    name=self.index_name,
+                    dimension=self.dimension,
+                    metric=self.metric,
+                    spec={
+                        "serverless": {
+                            "cloud": "aws",
+                            "region": "us-east-1"
+                        }
                     }
-                }
-            )
+                )
+            except Exception as e:
+                # Another worker starting at the same time created it first
+                if not _is_already_exists(e):
+                    raise
+                logger.info("Index %s was created concurrently; using it", self.index_name)
+                description = self.pc.describe_index(self.index_name)
+                logger.info("Index description: %s", description)
 
-        # Connect to index
-        self.index = self.pc.Index(self.index_name)
-        logger.info(f"Connected to index: {self.index_name}")
+        # Connect to index. The HTTP client keeps one urllib3 pool for the life
+        # of the service; pool_threads sizes the worker pool behind async_req
+        # (the SDK default of 1 would serialize batched upserts).
+        if self.use_grpc:
+            self.index = self.pc.Index(self.index_name)
+        else:
+            self.index = self.pc.Index(self.index_name, pool_threads=settings.pinecone_pool_threads)
+        logger.info("Connected to index: %s", self.index_name)
 
-        # Optional: check stats
+    def log_index_stats(self) -> None:
+        """
+        Log index stats; only informational, so it is kept out of __init__.
+        """
         try:
             stats = self.index.describe_index_stats()
-            logger.info(f"Pinecone index stats: {stats}")
+            logger.info("Pinecone index stats: %s", stats)
         except Exception as e:
-            logger.warning(f"Could not fetch index stats: {e}")
+            logger.warning("Could not fetch index stats: %s", e)
+
+    def _wire_values(self, values: np.ndarray) -> list:
+        """
+        Normalize and convert vectors to the lists the SDK sends.
+
+        float32 values become 17-digit floats in JSON (0.1 -> 0.10000000149011612).
+        Rounding unit vectors to value_decimals places roughly halves the
+        payload at an error far below fp16 precision. The gRPC transport sends
+        binary floats, so rounding is skipped there.
+        """
+        values = _unit_rows(values)
+        if self.value_decimals > 0 and not self.use_grpc:
+            values = np.round(values.astype(np.float64), self.value_decimals)
+        return values.tolist()
+
+    def _upsert_slices(self, vectors: list, metadata_sizes: List[int], batch_size: int) -> List[list]:
+        """
+        Split vectors by count and by estimated JSON request size.
+        """
+        # ~ bytes per serialized value: rounded floats are short, raw float32
+        # reprs run to 17 digits; binary gRPC floats are smaller still
+        value_bytes = self.value_decimals + 5 if 0 < self.value_decimals < 15 else 20
+        slices, current, current_bytes = [], [], 0
+        for v, metadata_size in zip(vectors, metadata_sizes):
+            size = self.dimension * value_bytes + metadata_size + 64
+            if current and (len(current) >= batch_size or current_bytes + size > MAX_UPSERT_REQUEST_BYTES):
+                slices.append(current)
+                current, current_bytes = [], 0
+            current.append(v)
+            current_bytes += size
+        if current:
+            slices.append(current)
+        return slices
+
+    def _wait(self, futures) -> None:
+        for future in futures:
+            # HTTP returns ApplyResult (.get), gRPC returns a grpc future (.result)
+            future.result() if self.use_grpc else future.get()
 
     # -------------------------------------------------------------------------
     # UPSERT VECTORS
     # -------------------------------------------------------------------------
     def upsert_vectors(self, vectors) -> bool:
+        return self.upsert_vectors_batched(vectors)
+
+    def upsert_vectors_batched(self, vectors, batch_size: Optional[int] = None) -> bool:
+        """
+        Upsert vectors in slices of at most batch_size vectors
+        (PINECONE_BATCH_SIZE by default) that also stay under the 2 MB request
+        limit. Multiple slices are sent concurrently with async_req and awaited
+        together.
+        """
+        batch_size = batch_size or self.batch_size
         try:
             if not vectors:
                 logger.warning("No vectors to upsert")
                 return False
 
+            # The encoded sizes are used for slicing
+            metadata, metadata_sizes = [], []
             for v in vectors:
-                if len(v["values"]) != self.dimension:
-                    raise ValueError(
-                        f"Embedding dimension mismatch: expected {self.dimension}, got {len(v['values'])}"
-                    )
+                meta, size = _json_metadata(v.get("id"), v.get("metadata", {}))
+                metadata.append(meta)
+                metadata_sizes.append(size)
+
+            # Validate every dimension with one shape check instead of a len() per vector
+            try:
+                values = np.asarray([v["values"] for v in vectors], dtype=np.float32)
+            except ValueError:
+                raise ValueError(f"Embedding dimension mismatch: expected {self.dimension} for every vector")
+            if values.shape != (len(vectors), self.dimension):
+                raise ValueError(
+                    f"Embedding dimension mismatch: expected {self.dimension}, got shape {values.shape}"
+                )
 
-            logger.info(f"Upserting {len(vectors)} vectors…")
+            # Normalized once here, scores are unchanged under cosine and the
+            # index can use dotproduct
+            vectors = [
+                {**v, "values": row, "metadata": meta}
+                for v, row, meta in zip(vectors, self._wire_values(values), metadata)
+            ]
+
+            logger.info("Upserting %d vectors…", len(vectors))
             
             # Add logging for the first vector to debug
-            if vectors:
-                logger.info(f"First vector ID: {vectors[0].get('id', 'N/A')}")
-                logger.info(f"First vector dimension: {len(vectors[0].get('values', []))}")
-                logger.info(f"First vector metadata keys: {list(vectors[0].get('metadata', {}).keys())}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("First vector ID: %s", vectors[0].get('id', 'N/A'))
+                logger.info("First vector dimension: %d", len(vectors[0].get('values', [])))
+                logger.info("First vector metadata keys: %s", list(vectors[0].get('metadata', {}).keys()))
 
-            self.index.upsert(vectors=vectors)
+            slices = self._upsert_slices(vectors, metadata_sizes, batch_size)
+            if len(slices) == 1:
+                self.index.upsert(vectors=vectors)
+            else:
+                self._wait([self.index.upsert(vectors=batch, async_req=True) for batch in slices])
+                logger.info("Upserted in %d batches of up to %d", len(slices), max(map(len, slices)))
             logger.info("✔ Upsert successful")
 
             return True
 
         except Exception as e:
-            logger.error(f"❌ Error upserting vectors: {e}")
+            logger.error("❌ Error upserting vectors: %s", e)
             logger.exception(e)
             return False
+        finally:
+            # A failed write may still have partly reached the index
+            self.result_cache.clear()
 
     # -------------------------------------------------------------------------
     # QUERY SIMILAR VECTORS
@@ -94,12 +293,21 @@ class PineconeService:
                     f"Query vector dimension mismatch: expected {self.dimension}, got {len(query_vector)}"
                 )
 
-            logger.info(f"Querying Pinecone (top_k={top_k})")
-            logger.info(f"Query vector dimension: {len(query_vector)}")
-            logger.info(f"Index dimension: {self.dimension}")
+            # Read before querying so a write that lands meanwhile voids the store
+            generation = self.result_cache.generation
+            cached = self.result_cache.lookup(query_vector, top_k)
+            if cached is not None:
+                logger.debug("✔ Pinecone result cache hit (%d matches)", len(cached))
+                return cached
+
+            logger.debug("Querying Pinecone (top_k=%d)", top_k)
+            logger.debug("Query vector dimension: %d", len(query_vector))
+            logger.debug("Index dimension: %d", self.dimension)
+
+            query_values = self._wire_values(np.asarray(query_vector, dtype=np.float32))
+            rerank = self.rerank_candidates > top_k
 
             # Add timeout and retry logic for Render deployment
-            import time
             max_retries = 3
             retry_delay = 1
             response = None
@@ -107,15 +315,16 @@ class PineconeService:
             for attempt in range(max_retries):
                 try:
                     response = self.index.query(
-                        vector=query_vector,
-                        top_k=top_k,
+                        vector=query_values,
+                        top_k=self.rerank_candidates if rerank else top_k,
+                        include_values=rerank,
                         include_metadata=True
                     )
                     break  # Success, break out of retry loop
                 except Exception as e:
-                    logger.warning(f"Attempt {attempt + 1} failed: {e}")
+                    logger.warning("Attempt %d failed: %s", attempt + 1, e)
                     if attempt < max_retries - 1:  # Not the last attempt
-                        logger.info(f"Retrying in {retry_delay} seconds...")
+                        logger.info("Retrying in %s seconds...", retry_delay)
                         time.sleep(retry_delay)
                         retry_delay *= 2  # Exponential backoff
                     else:
@@ -132,50 +341,169 @@ class PineconeService:
             else:
                 matches = getattr(response, "matches", [])
 
-            logger.info(f"✔ Pinecone returned {len(matches)} matches")
-
-            cleaned = []
-            for m in matches:
-                meta = m.get("metadata", {})
+            logger.debug("✔ Pinecone returned %d matches", len(matches))
 
-                # Metadata cleanup: convert string → dict if needed
+            # Matches are dict-like (.get/[]) in both SDK transports, so they are
+            # returned as-is; only legacy matches with string metadata get rebuilt
+            matches = list(matches)
+            values = [m.get("values") for m in matches] if rerank else None
+            for i, m in enumerate(matches):
+                meta = m.get("metadata")
                 if isinstance(meta, str):
-                    try:
-                        meta = ast.literal_eval(meta)
-                    except Exception:
-                        try:
-                            meta = json.loads(meta.replace("'", '"'))
-                        except Exception:
-                            logger.warning(f"Could not parse metadata for vector {m.get('id')}")
-                            meta = {}
-
-                cleaned.append({
-                    "id": m.get("id"),
-                    "score": m.get("score"),
-                    "metadata": meta
-                })
-
-            logger.info(f"Matches returned: {len(cleaned)}")
-            return cleaned
+                    matches[i] = {
+                        "id": m.get("id"),
+                        "score": m.get("score"),
+                        "metadata": _parse_legacy_metadata(m.get("id"), meta)
+                    }
+
+            if rerank:
+                if matches and all(values):
+                    matches = _rerank(matches, values, query_vector, top_k)
+                else:
+                    matches = matches[:top_k]
+
+            self.result_cache.store(query_vector, top_k, matches, generation)
+            return matches
 
         except Exception as e:
-            logger.error(f"❌ Error querying Pinecone: {e}")
+            logger.error("❌ Error querying Pinecone: %s", e)
             logger.exception(e)
             return []
 
+    def batch_query(self, query_vectors: list, top_k: int = 5) -> List[list]:
+        """
+        Run several similarity queries in parallel; results keep the input order.
+        """
+        if len(query_vectors) <= 1:
+            return [self.query_similar(v, top_k) for v in query_vectors]
+        with ThreadPoolExecutor(max_workers=min(8, len(query_vectors))) as executor:
+            return list(executor.map(lambda v: self.query_similar(v, top_k), query_vectors))
+
+    @staticmethod
+    def _merge_matches(results: List[list]) -> list:
+        """
+        Union of several queries' matches, one per id (its best score), best first.
+        """
+        best: Dict[str, Any] = {}
+        for matches in results:
+            for m in matches:
+                current = best.get(m.get("id"))
+                if current is None or (m.get("score") or 0) > (current.get("score") or 0):
+                    best[m.get("id")] = m
+        return sorted(best.values(), key=lambda m: m.get("score") or 0, reverse=True)
+
+    def query_similar_batch(self, query_vectors: list, top_k: int = 5) -> list:
+        """
+        Multi-query retrieval (e.g. HyDE, multi-hop): run the queries in
+        parallel and return their deduplicated matches.
+        """
+        return self._merge_matches(self.batch_query(query_vectors, top_k))
+
+    # -------------------------------------------------------------------------
+    # FETCH VECTORS
+    # -------------------------------------------------------------------------
+    def fetch_vectors(self, ids: List[str]) -> Dict[str, Any]:
+        """
+        Fetch vectors by id; returns {id: vector} for the ids that exist.
+        """
+        try:
+            response = self.index.fetch(ids=ids)
+            if isinstance(response, dict):
+                return response.get("vectors") or {}
+            return getattr(response, "vectors", None) or {}
+        except Exception as e:
+            logger.error("❌ Error fetching vectors: %s", e)
+            return {}
+
+    def list_ids(self, prefix: str) -> Optional[set]:
+        """
+        Ids of stored vectors starting with prefix. Only ids come back (no
+        values or metadata); None when listing fails or is unsupported
+        (pod-based indexes), so callers can tell that apart from "no ids".
+        """
+        try:
+            return {vector_id for page in self.index.list(prefix=prefix) for vector_id in page}
+        except Exception as e:
+            logger.warning("Could not list vector ids with prefix %s: %s", prefix, e)
+            return None
+
     # -------------------------------------------------------------------------
     # DELETE VECTORS
     # -------------------------------------------------------------------------
     def delete_vectors(self, ids: List[str]) -> bool:
         try:
-            logger.info(f"Deleting {len(ids)} vectors…")
-            self.index.delete(ids=ids)
+            logger.info("Deleting %d vectors…", len(ids))
+            if len(ids) <= MAX_DELETE_IDS:
+                self.index.delete(ids=ids)
+            else:
+                self._wait([
+                    self.index.delete(ids=ids[i:i + MAX_DELETE_IDS], async_req=True)
+                    for i in range(0, len(ids), MAX_DELETE_IDS)
+                ])
             logger.info("✔ Delete successful")
             return True
         except Exception as e:
-            logger.error(f"❌ Error deleting vectors: {e}")
+            logger.error("❌ Error deleting vectors: %s", e)
             logger.exception(e)
             return False
+        finally:
+            # A failed write may still have partly reached the index
+            self.result_cache.clear()
+
+    # -------------------------------------------------------------------------
+    # UPDATE METADATA
+    # -------------------------------------------------------------------------
+    def update_metadata(self, ids: List[str], metadata: Dict[str, Any]) -> bool:
+        """
+        Set metadata fields on existing vectors in place, without re-uploading
+        their values. Fields not in metadata are left as they are; values are
+        normalized the same way as on upsert.
+        """
+        try:
+            metadata = _json_metadata(ids[0] if ids else None, metadata)[0]
+            logger.info("Updating metadata of %d vectors…", len(ids))
+            if len(ids) == 1:
+                self.index.update(id=ids[0], set_metadata=metadata)
+            else:
+                self._wait([
+                    self.index.update(id=vector_id, set_metadata=metadata, async_req=True)
+                    for vector_id in ids
+                ])
+            return True
+        except Exception as e:
+            logger.error("❌ Error updating metadata: %s", e)
+            logger.exception(e)
+            return False
+        finally:
+            # A failed write may still have partly reached the index
+            self.result_cache.clear()
+
+    # -------------------------------------------------------------------------
+    # ASYNC WRAPPERS
+    # -------------------------------------------------------------------------
+    # The Pinecone SDK is synchronous; run its blocking calls in a worker
+    # thread so they don't stall the event loop.
+    async def aupsert_vectors(self, vectors) -> bool:
+        return await asyncio.to_thread(self.upsert_vectors, vectors)
+
+    async def aquery_similar(self, query_vector, top_k: int = 5):
+        return await asyncio.to_thread(self.query_similar, query_vector, top_k)
+
+    async def aquery_similar_batch(self, query_vectors: list, top_k: int = 5) -> list:
+        results = await asyncio.gather(*(self.aquery_similar(v, top_k) for v in query_vectors))
+        return self._merge_matches(results)
+
+    async def afetch_vectors(self, ids: List[str]) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.fetch_vectors, ids)
+
+    async def alist_ids(self, prefix: str) -> Optional[set]:
+        return await asyncio.to_thread(self.list_ids, prefix)
+
+    async def adelete_vectors(self, ids: List[str]) -> bool:
+        return await asyncio.to_thread(self.delete_vectors, ids)
+
+    async def aupdate_metadata(self, ids: List[str], metadata: Dict[str, Any]) -> bool:
+        return await asyncio.to_thread(self.update_metadata, ids, metadata)
 
     # -------------------------------------------------------------------------
     # LISTING (NOT SUPPORTED IN SERVERLESS)
@@ -0,0 +1,366 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import simsimd
+except ImportError:  # optional SIMD kernels; numpy is used as a fallback
+    simsimd = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class QueryCache:
+    """
+    Two-tier cache for /query responses.
+
+    1. Exact match on the normalized query text (plus top_k).
+    2. Semantic match: cosine similarity between the new query embedding and
+       the embeddings of cached queries.
+
+    Query embeddings are kept in one contiguous (slots, dim) matrix so the
+    semantic scan is a single SimSIMD (or numpy) call rather than a Python
+    loop. Rows are L2-normalized on insert, so cosine similarity is a plain
+    inner product. With SimSIMD the rows are int8-quantized (per-row
+    symmetric scale), a quarter of the f32 footprint and memory traffic.
+
+    Each row also gets a 16-bit random-projection LSH signature; only rows
+    within a small Hamming distance of the query's signature are scored, so
+    most of the matrix is skipped while near-duplicates are kept (at
+    cos >= 0.95 signatures differ in ~1.6 of 16 bits on average).
+
+    Entries expire after ttl_seconds and the least recently used entry is
+    evicted once max_size is reached. All operations are thread-safe.
+    """
+
+    def __init__(self, max_size: int = 2000, ttl_seconds: int = 600,
+                 similarity_threshold: float = 0.95, lsh_bits: int = 16, max_hamming: int = 4):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.lsh_bits = lsh_bits
+        self.max_hamming = max_hamming
+        self._entries: "OrderedDict[Tuple[str, int], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        # SimSIMD has native int8 kernels; numpy has no fast int8 matmul, so
+        # keep f32 when falling back.
+        self._dtype = np.int8 if simsimd is not None else np.float32
+        # Structure-of-arrays storage for the semantic tier, allocated lazily
+        # once the embedding dimension is known and grown by doubling.
+        self._vectors: Optional[np.ndarray] = None
+        self._projection: Optional[np.ndarray] = None
+        self._slot_sig = np.zeros(0, dtype=np.uint16)
+        self._slot_top_k = np.zeros(0, dtype=np.int32)
+        self._slot_time = np.zeros(0, dtype=np.float64)
+        self._slot_scale = np.zeros(0, dtype=np.float32)
+        self._slot_active = np.zeros(0, dtype=bool)
+        self._slot_keys: List[Optional[Tuple[str, int]]] = []
+        self._free_slots: List[int] = []
+
+        logger.info(
+            "Query cache initialized (max_size=%d, ttl=%ds, similarity_threshold=%s, simsimd=%s)",
+            max_size, ttl_seconds, similarity_threshold, simsimd is not None
+        )
+
+    @staticmethod
+    def make_key(query: str, top_k: int) -> Tuple[str, int]:
+        return query.strip().lower(), top_k
+
+    @staticmethod
+    def _normalize(vector) -> Optional[np.ndarray]:
+        vec = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return None
+        return vec / norm
+
+    def _encode(self, vec: np.ndarray) -> Tuple[np.ndarray, float]:
+        """
+        Convert a unit vector to the storage dtype; returns (payload, scale).
+        """
+        if self._dtype != np.int8:
+            return vec.astype(self._dtype), 1.0
+        scale = float(np.max(np.abs(vec))) / 127
+        return np.round(vec / scale).astype(np.int8), scale
+
+    def _signature(self, vec: np.ndarray) -> int:
+        bits = (vec @ self._projection) > 0
+        return int(np.packbits(bits, bitorder="little").view(np.uint16)[0])
+
+    def _candidates(self, sig: int) -> np.ndarray:
+        """
+        Mask of slots whose signature is within max_hamming bits of sig
+        """
+        diff = np.bitwise_xor(self._slot_sig, np.uint16(sig))
+        distance = np.unpackbits(diff.view(np.uint8)).reshape(-1, 16).sum(axis=1)
+        return distance <= self.max_hamming
+
+    def _is_expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return now - entry["timestamp"] > self.ttl_seconds
+
+    # -------------------------------------------------------------------------
+    # SLOT MANAGEMENT (caller holds the lock)
+    # -------------------------------------------------------------------------
+    def _grow(self, dimension: int) -> None:
+        old = 0 if self._vectors is None else self._vectors.shape[0]
+        new = min(self.max_size, max(16, old * 2))
+        vectors = np.zeros((new, dimension), dtype=self._dtype)
+        if self._vectors is not None:
+            vectors[:old] = self._vectors
+        else:
+            # Fixed hyperplanes, drawn once the dimension is known
+            self._projection = np.random.default_rng(0).standard_normal(
+                (dimension, self.lsh_bits)).astype(np.float32)
+        self._vectors = vectors
+        self._slot_sig = np.resize(self._slot_sig, new)
+        self._slot_top_k = np.resize(self._slot_top_k, new)
+        self._slot_time = np.resize(self._slot_time, new)
+        self._slot_scale = np.resize(self._slot_scale, new)
+        self._slot_active = np.concatenate([self._slot_active, np.zeros(new - old, dtype=bool)])
+        self._slot_keys.extend([None] * (new - old))
+        self._free_slots.extend(range(new - 1, old - 1, -1))
+
+    def _store_vector(self, key: Tuple[str, int], vec: np.ndarray, timestamp: float) -> Optional[int]:
+        if self._vectors is not None and self._vectors.shape[1] != vec.shape[0]:
+            logger.warning("Query cache ignoring vector with dimension %d", vec.shape[0])
+            return None
+        if not self._free_slots:
+            self._grow(vec.shape[0])
+        slot = self._free_slots.pop()
+        self._vectors[slot], self._slot_scale[slot] = self._encode(vec)
+        self._slot_sig[slot] = self._signature(vec)
+        self._slot_top_k[slot] = key[1]
+        self._slot_time[slot] = timestamp
+        self._slot_active[slot] = True
+        self._slot_keys[slot] = key
+        return slot
+
+    def _release(self, entry: Dict[str, Any]) -> None:
+        slot = entry.get("slot")
+        if slot is not None:
+            self._slot_active[slot] = False
+            self._slot_keys[slot] = None
+            self._free_slots.append(slot)
+
+    def _similarities(self, q: np.ndarray, slots: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarity of q against the given slots
+        """
+        payload, scale = self._encode(q)
+        rows = self._vectors[slots]
+        if simsimd is not None:
+            # Both sides are unit vectors, so the inner product is the cosine;
+            # undo the int8 quantization scales afterwards.
+            dots = np.asarray(simsimd.cdist(payload[None, :], rows, metric="inner"))[0]
+            return dots * (scale * self._slot_scale[slots])
+        # Stored rows are unit-length, so cosine is a single matrix-vector product
+        return rows @ payload
+
+    # -------------------------------------------------------------------------
+    # PUBLIC API
+    # -------------------------------------------------------------------------
+    def get(self, query: str, top_k: int) -> Optional[str]:
+        """
+        Exact-match lookup. Returns the cached response or None.
+        """
+        key = self.make_key(query, top_k)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_expired(entry, time.time()):
+                    self._release(self._entries.pop(key))
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    logger.debug("Query cache exact hit (hits=%d, misses=%d)", self.hits, self.misses)
+                    return entry["response"]
+        return None
+
+    def get_similar(self, query_vector: List[float], top_k: int) -> Optional[str]:
+        """
+        Semantic lookup against cached query embeddings.
+        Counts a miss when nothing is similar enough.
+        """
+        q = self._normalize(query_vector)
+        with self._lock:
+            if q is not None and self._vectors is not None and self._vectors.shape[1] == q.shape[0]:
+                valid = (
+                    self._slot_active
+                    & (self._slot_top_k == top_k)
+                    & (time.time() - self._slot_time <= self.ttl_seconds)
+                    & self._candidates(self._signature(q))
+                )
+                slots = np.flatnonzero(valid)
+                if slots.size:
+                    sims = self._similarities(q, slots)
+                    i = int(np.argmax(sims))
+                    best = int(slots[i])
+                    if sims[i] >= self.similarity_threshold:
+                        key = self._slot_keys[best]
+                        self._entries.move_to_end(key)
+                        self.semantic_hits += 1
+                        logger.debug(
+                            "Query cache semantic hit (similarity=%.4f, semantic_hits=%d, misses=%d)",
+                            sims[i], self.semantic_hits, self.misses
+                        )
+                        return self._entries[key]["response"]
+
+            self.misses += 1
+            logger.debug("Query cache miss (hits=%d, semantic_hits=%d, misses=%d)", self.hits, self.semantic_hits, self.misses)
+        return None
+
+    def put(self, query: str, top_k: int, response: str, query_vector: Optional[List[float]] = None) -> None:
+        key = self.make_key(query, top_k)
+        q = self._normalize(query_vector) if query_vector is not None else None
+        now = time.time()
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._release(previous)
+            while len(self._entries) >= self.max_size:
+                self._release(self._entries.popitem(last=False)[1])
+
+            self._entries[key] = {
+                "response": response,
+                "slot": self._store_vector(key, q, now) if q is not None else None,
+                "timestamp": now
+            }
+
+    def clear(self) -> None:
+        """
+        Drop every cached response, e.g. after new documents are ingested.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._slot_active[:] = False
+            self._slot_keys = [None] * len(self._slot_keys)
+            self._free_slots = list(range(len(self._slot_keys) - 1, -1, -1))
+        logger.info("Query cache cleared")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses
+            }
+
+
+class QVCache:
+    """
+    Client-side cache of vector-store results keyed by the query vector.
+
+    Unit-normalized query vectors are bucketed with a random-projection LSH
+    (the sign bits of q @ R), so a lookup only compares against the handful
+    of cached vectors in the same bucket (plus the bucket across the least
+    certain bit). A hit needs cosine >= similarity_threshold and a cached
+    top_k at least as large as requested.
+
+    Callers must clear() the cache whenever the index is written to. clear()
+    also bumps a write generation: callers read it before querying the index
+    and pass it to store(), which drops results from a query that overlapped
+    a write. Entries expire after ttl_seconds, which bounds staleness from
+    writes this process never sees (other workers).
+    """
+
+    def __init__(self, dimension: int, max_size: int = 2048, ttl_seconds: int = 300,
+                 similarity_threshold: float = 0.99, n_bits: int = 16, seed: int = 0):
+        self.dimension = dimension
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.generation = 0
+        # Fixed projection so bucket ids are stable for the life of the process
+        self._projection = np.random.default_rng(seed).standard_normal((dimension, n_bits)).astype(np.float32)
+        self._bit_values = 1 << np.arange(n_bits, dtype=np.int64)
+        self._entries: "OrderedDict[int, Tuple[np.ndarray, int, int, List[Dict[str, Any]], float]]" = OrderedDict()
+        self._buckets: Dict[int, List[int]] = {}
+        self._next_id = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _probes(self, q: np.ndarray) -> List[int]:
+        projected = q @ self._projection
+        bucket = int(self._bit_values[projected > 0].sum())
+        # Near-duplicates most often differ on the bit closest to the hyperplane
+        weakest = int(np.argmin(np.abs(projected)))
+        return [bucket, bucket ^ int(self._bit_values[weakest])]
+
+    def _drop(self, entry_id: int) -> None:
+        bucket = self._entries.pop(entry_id)[1]
+        members = self._buckets[bucket]
+        members.remove(entry_id)
+        if not members:
+            del self._buckets[bucket]
+
+    def lookup(self, query_vector, top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Return cached matches for a near-identical query vector, or None.
+        """
+        q = QueryCache._normalize(query_vector)
+        if q is None or q.shape[0] != self.dimension:
+            return None
+        probes = self._probes(q)
+        expired_before = time.time() - self.ttl_seconds
+        with self._lock:
+            best_id, best_sim = None, self.similarity_threshold
+            expired = []
+            for bucket in probes:
+                for entry_id in self._buckets.get(bucket, ()):
+                    vec, _, cached_top_k, _, stored_at = self._entries[entry_id]
+                    if stored_at < expired_before:
+                        expired.append(entry_id)
+                        continue
+                    if cached_top_k < top_k:
+                        continue
+                    sim = float(vec @ q)
+                    if sim >= best_sim:
+                        best_id, best_sim = entry_id, sim
+            for entry_id in expired:
+                self._drop(entry_id)
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return list(self._entries[best_id][3][:top_k])
+
+    def store(self, query_vector, top_k: int, matches: List[Dict[str, Any]], generation: int) -> None:
+        """
+        Cache matches from a query issued at the given write generation;
+        ignored if the index was written to since.
+        """
+        q = QueryCache._normalize(query_vector)
+        if q is None or q.shape[0] != self.dimension or self.max_size <= 0:
+            return
+        bucket = self._probes(q)[0]
+        with self._lock:
+            if generation != self.generation:
+                return
+            while len(self._entries) >= self.max_size:
+                self._drop(next(iter(self._entries)))
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (q, bucket, top_k, list(matches), time.time())
+            self._buckets.setdefault(bucket, []).append(entry_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
@@ -1,21 +1,47 @@
+import asyncio
+import hashlib
 import logging
-import uuid
-from typing import List, Dict, Any, Optional
-from embedding_service import SambaNovaEmbedding
+import re
+import time
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional
+
+import httpx
+import numpy as np
+
+from config import Settings, settings as default_settings
+from embedding_service import EmbeddingCache, make_embedding_service
 from pinecone_service import PineconeService
 from llm_service import SambaNovaLLM
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+QUERY_ERROR_RESPONSE = "Sorry, an error occurred while processing your query."
+NOT_FOUND_RESPONSE = "I could not find this information in the patient's medical records."
+# Per-chunk metadata written by _build_vector_data; caller metadata never overrides it
+RESERVED_METADATA_KEYS = frozenset({"content", "chunk_index", "total_chunks", "content_hash"})
+
 class RAGService:
-    def __init__(self):
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None, settings: Settings = default_settings,
+                 max_doc_chars: Optional[int] = None, max_context_chars: Optional[int] = None):
         logger.info("Initializing RAG service components...")
-        self.embedding_service = SambaNovaEmbedding()
+        self.settings = settings
+        # Context size limits; default to RAG_MAX_DOC_CHARS / RAG_CONTEXT_BUDGET
+        self.max_doc_chars = settings.rag_max_doc_chars if max_doc_chars is None else max_doc_chars
+        self.max_context_chars = settings.rag_context_budget if max_context_chars is None else max_context_chars
+        self.embedding_service = make_embedding_service(client=http_client, settings=settings)
+        # Query vectors keyed on normalized query text, shared across top_k
+        # values and endpoints; kept apart from document chunk embeddings
+        # (queries bypass embedding_service.cache and its SQLite file).
+        self.query_embeddings = EmbeddingCache(
+            self.embedding_service.model,
+            max_size=4096,
+            ttl_seconds=settings.embedding_cache_ttl
+        )
         logger.info("Embedding service initialized")
-        self.vector_store = PineconeService()
+        self.vector_store = PineconeService(settings=settings)
         logger.info("Vector store initialized")
-        self.llm_service = SambaNovaLLM()
+        self.llm_service = SambaNovaLLM(client=http_client, settings=settings)
         logger.info("LLM service initialized")
         logger.info("RAG service components initialized successfully")
 
@@ -23,55 +49,32 @@ class RAGService:
         """
         Split text into chunks with overlap.
 
-        Fixed edge-cases:
-        - Prevents negative start index when overlap > chunk length.
-        - Breaks if start doesn't advance to avoid infinite loops.
-        - Adds a defensive max-iterations guard.
+        Chunk boundaries are computed up front as index arrays, so there is no
+        loop to guard. Edge-cases:
+        - overlap >= chunk_size falls back to adjacent chunks (no overlap).
+        - The last chunk always reaches the end of the text; no trailing chunk
+          made up only of the previous chunk's overlap is emitted.
+        - Whitespace-only chunks (and whitespace-only text) are dropped, so
+          they never reach the embedding API as zero-information vectors.
         """
-        if not text:
+        if not text or not text.strip():
             return []
 
-        chunks: List[str] = []
         text_length = len(text)
-        start = 0
-
-        # Defensive guard to avoid accidental infinite loops
-        max_iterations = max(10, (text_length // max(1, chunk_size - overlap)) + 10)
-        iterations = 0
-
-        while start < text_length and iterations < max_iterations:
-            end = min(start + chunk_size, text_length)
-            # append the chunk slice
-            chunks.append(text[start:end])
-
-            # compute next start taking care not to go negative
-            next_start = max(0, end - overlap)
-
-            # If next_start doesn't move forward, break to prevent infinite loop
-            if next_start <= start:
-                # try to move to end to finish
-                if end >= text_length:
-                    break
-                # otherwise move to end (no overlap)
-                start = end
-            else:
-                start = next_start
-
-            iterations += 1
-
-        if iterations >= max_iterations:
-            logger.warning(
-                "_chunk_text reached max_iterations; text_length=%d, chunk_size=%d, overlap=%d",
-                text_length, chunk_size, overlap
-            )
-
-        return chunks
+        stride = chunk_size - overlap
+        if stride > 0:
+            starts = np.arange(0, max(text_length - overlap, 1), stride)
+        else:
+            starts = np.arange(0, text_length, chunk_size)
+        ends = np.minimum(starts + chunk_size, text_length)
+        chunks = (text[s:e] for s, e in zip(starts.tolist(), ends.tolist()))
+        return [chunk for chunk in chunks if chunk.strip()]
 
-    def _combine_text_for_embedding(self, chunk: str, metadata: Dict[str, Any]) -> str:
+    def _build_metadata_header(self, metadata: Dict[str, Any]) -> str:
         """
-        Combine metadata + chunk content for embedding.
+        Metadata lines prepended to every chunk of a document for embedding.
         This ensures that queries about patient names, IDs, and other metadata
-        will match the stored documents.
+        will match the stored documents. Built once per document.
         """
         # Extract all possible metadata fields
         patient_name = metadata.get("patient_name", metadata.get("patient", ""))
@@ -99,118 +102,614 @@ class RAGService:
             parts.append(f"Doctor: {doctor}")
         if source:
             parts.append(f"Source: {source}")
-            
-        # Add the main content
-        parts.append(f"Medical Notes: {chunk}")
-        
-        combined_text = "\n".join(parts)
-        return combined_text
 
-    def add_document(self, content: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
+        return "".join(f"{part}\n" for part in parts)
+
+    def _combine_texts_for_embedding(self, chunks: List[str], metadata: Dict[str, Any]) -> List[str]:
+        """
+        Combine the metadata header + each chunk's content for embedding.
+        """
+        header = self._build_metadata_header(metadata)
+        return [f"{header}Medical Notes: {chunk}" for chunk in chunks]
+
+    @staticmethod
+    def _note_id_prefix(metadata: Dict[str, Any]) -> str:
+        """
+        Id prefix shared by every chunk of one note: a digest of the patient
+        and visit date, resolved the same way as in _build_metadata_header.
+        """
+        patient_id = metadata.get("patient_id", metadata.get("id", ""))
+        date_time = metadata.get("date_time", metadata.get("visit_date", metadata.get("date", "")))
+        key = f"{patient_id}\0{date_time}".encode("utf-8")
+        return f"{hashlib.blake2b(key, digest_size=8).hexdigest()}#"
+
+    def _chunk_ids(self, chunks: List[str], metadata: Optional[Dict[str, Any]],
+                   doc_id: Optional[str] = None) -> List[str]:
+        """
+        Vector ids for a document's chunks: "{doc_id}-{chunk_index}" when doc_id
+        is given, otherwise the note prefix plus a BLAKE2b digest of the chunk,
+        so re-ingesting the same note overwrites instead of duplicating.
+
+        The same chunk text in a note for another visit date gets its own id.
+        Within one note a repeated chunk is stored once, with the metadata
+        (chunk_index) of its first occurrence.
+        """
+        if doc_id:
+            return [f"{doc_id}-{i}" for i in range(len(chunks))]
+        prefix = self._note_id_prefix(metadata or {})
+        return [
+            prefix + hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).hexdigest()
+            for chunk in chunks
+        ]
+
+    @staticmethod
+    def _pending_chunks(ids: List[str], existing: set) -> List[int]:
+        """
+        Indices of chunks that still need embedding and upsert: ids not already
+        stored, first occurrence only.
+        """
+        seen = set(existing)
+        pending = []
+        for i, vector_id in enumerate(ids):
+            if vector_id not in seen:
+                seen.add(vector_id)
+                pending.append(i)
+        return pending
+
+    def add_document(self, content: str, metadata: Optional[Dict[str, Any]] = None,
+                     doc_id: Optional[str] = None, skip_existing: bool = False) -> bool:
+        """
+        Chunk, embed and upsert a document. When doc_id is given, chunk vectors
+        get the ids "{doc_id}-{chunk_index}" so callers can look them up later.
+        Otherwise ids are content hashes and re-ingest is an idempotent upsert;
+        skip_existing additionally lists the note's stored ids (ids only, one
+        request) and skips embedding chunks that are already there.
+        """
         try:
-            logger.info(f"Starting document addition. Content length: {len(content) if content else 0}")
-            logger.info(f"Metadata: {metadata}")
+            logger.info("Starting document addition. Content length: %d", len(content) if content else 0)
+            logger.debug("Metadata: %s", metadata)
             chunks = self._chunk_text(content)
-            logger.info(f"Document chunked into {len(chunks)} chunks")
-            vector_data = []
+            logger.info("Document chunked into %d chunks", len(chunks))
 
-            for i, chunk in enumerate(chunks):
-                logger.info(f"Processing chunk {i+1}/{len(chunks)}")
+            ids = self._chunk_ids(chunks, metadata, doc_id)
+            # Explicit doc_ids are always rewritten
+            check = skip_existing and ids and not doc_id
+            existing = (self.vector_store.list_ids(self._note_id_prefix(metadata or {})) or set()) if check else set()
+            pending = self._pending_chunks(ids, existing)
+            if existing:
+                logger.info("Skipping %d chunks already in the index", len(chunks) - len(pending))
 
-                combined_text = self._combine_text_for_embedding(chunk, metadata or {})
-                logger.info(f"Combined text length: {len(combined_text)}")
+            combined_texts = self._combine_texts_for_embedding([chunks[i] for i in pending], metadata or {})
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Combined text lengths: %s", [len(text) for text in combined_texts])
+
+            # One embeddings request per batch of chunks rather than per chunk
+            embeddings = self.embedding_service.embed_batch(combined_texts) if combined_texts else []
+            logger.info("Generated %d embeddings", len(embeddings))
+
+            vector_data = self._build_vector_data(chunks, embeddings, metadata, ids, pending,
+                                                  self._content_hash(content))
+
+            if not vector_data:
+                logger.info("No new vectors to upsert. Skipping upsert.")
+                return True
+
+            logger.info("Upserting %d vectors to Pinecone", len(vector_data))
+            result = self.vector_store.upsert_vectors(vector_data)
+            logger.info("Vector upsert result: %s", result)
+            return result
+
+        except Exception as e:
+            logger.error("Error adding document: %s", e)
+            logger.exception(e)
+            return False
 
-                embedding = self.embedding_service.get_single_embedding(combined_text)
-                logger.info(f"Embedding generated. Dimension: {len(embedding) if embedding else 0}")
+    async def aadd_document(self, content: str, metadata: Optional[Dict[str, Any]] = None,
+                            doc_id: Optional[str] = None, skip_existing: bool = False) -> bool:
+        """
+        Async variant of add_document; embedding batches are requested concurrently.
+        """
+        try:
+            logger.info("Starting document addition (async). Content length: %d", len(content) if content else 0)
+            chunks = self._chunk_text(content)
+            logger.info("Document chunked into %d chunks", len(chunks))
 
-                doc_id = str(uuid.uuid4())
-                logger.info(f"Generated document ID: {doc_id}")
+            ids = self._chunk_ids(chunks, metadata, doc_id)
+            check = skip_existing and ids and not doc_id
+            existing = (await self.vector_store.alist_ids(self._note_id_prefix(metadata or {})) or set()) if check else set()
+            pending = self._pending_chunks(ids, existing)
+            if existing:
+                logger.info("Skipping %d chunks already in the index", len(chunks) - len(pending))
 
-                chunk_metadata = metadata.copy() if metadata else {}
-                chunk_metadata["content"] = chunk
-                chunk_metadata["chunk_index"] = i
-                chunk_metadata["total_chunks"] = len(chunks)
-                logger.info(f"Chunk metadata: {chunk_metadata}")
+            combined_texts = self._combine_texts_for_embedding([chunks[i] for i in pending], metadata or {})
+            embeddings = await self.embedding_service.aembed_batch(combined_texts) if combined_texts else []
 
-                vector_data.append({
-                    "id": doc_id,
-                    "values": embedding,
-                    "metadata": chunk_metadata
-                })
-                logger.info(f"Chunk {i+1} processed successfully")
+            vector_data = self._build_vector_data(chunks, embeddings, metadata, ids, pending,
+                                                  self._content_hash(content))
 
             if not vector_data:
-                logger.info("No vectors to upsert (empty document after chunking). Skipping upsert.")
+                logger.info("No new vectors to upsert. Skipping upsert.")
+                return True
+
+            logger.info("Upserting %d vectors to Pinecone", len(vector_data))
+            result = await self.vector_store.aupsert_vectors(vector_data)
+            logger.info("Vector upsert result: %s", result)
+            return result
+
+        except Exception as e:
+            logger.error("Error adding document: %s", e)
+            logger.exception(e)
+            return False
+
+    def _prepare_documents(self, contents: List[str],
+                           metadatas: Optional[List[Optional[Dict[str, Any]]]]):
+        """
+        Chunk every document and collect all texts to embed, in order.
+        Returns (per-document (chunks, ids, pending, metadata, content hash),
+        combined texts).
+        """
+        if metadatas is None:
+            metadatas = [None] * len(contents)
+        if len(metadatas) != len(contents):
+            raise ValueError(f"Got {len(metadatas)} metadata dicts for {len(contents)} documents")
+
+        documents, combined_texts = [], []
+        for content, metadata in zip(contents, metadatas):
+            chunks = self._chunk_text(content)
+            ids = self._chunk_ids(chunks, metadata)
+            pending = self._pending_chunks(ids, set())
+            documents.append((chunks, ids, pending, metadata, self._content_hash(content)))
+            combined_texts.extend(self._combine_texts_for_embedding([chunks[i] for i in pending], metadata or {}))
+        return documents, combined_texts
+
+    def _bulk_vector_data(self, documents, embeddings: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        Split one embedding matrix back over the documents from _prepare_documents.
+        Ids repeated across documents are upserted once (last one wins).
+        """
+        vectors: Dict[str, Dict[str, Any]] = {}
+        offset = 0
+        for chunks, ids, pending, metadata, content_hash in documents:
+            doc_embeddings = embeddings[offset:offset + len(pending)]
+            offset += len(pending)
+            for vector in self._build_vector_data(chunks, doc_embeddings, metadata, ids, pending, content_hash):
+                vectors[vector["id"]] = vector
+        return list(vectors.values())
+
+    def add_documents(self, contents: List[str],
+                      metadatas: Optional[List[Optional[Dict[str, Any]]]] = None) -> bool:
+        """
+        Bulk add_document: the chunks of all documents share one embed_batch
+        call (max-size batches across document boundaries) and one upsert.
+        """
+        try:
+            documents, combined_texts = self._prepare_documents(contents, metadatas)
+            logger.info("Adding %d documents (%d chunks)", len(documents), len(combined_texts))
+            if not combined_texts:
+                logger.info("No vectors to upsert. Skipping upsert.")
                 return True
 
-            logger.info(f"Upserting {len(vector_data)} vectors to Pinecone")
+            embeddings = self.embedding_service.embed_batch(combined_texts)
+            vector_data = self._bulk_vector_data(documents, embeddings)
+
+            logger.info("Upserting %d vectors to Pinecone", len(vector_data))
             result = self.vector_store.upsert_vectors(vector_data)
-            logger.info(f"Vector upsert result: {result}")
+            logger.info("Vector upsert result: %s", result)
+            return result
+
+        except Exception as e:
+            logger.error("Error adding documents: %s", e)
+            logger.exception(e)
+            return False
+
+    async def aadd_documents(self, contents: List[str],
+                             metadatas: Optional[List[Optional[Dict[str, Any]]]] = None) -> bool:
+        """
+        Async variant of add_documents
+        """
+        try:
+            documents, combined_texts = self._prepare_documents(contents, metadatas)
+            logger.info("Adding %d documents (%d chunks, async)", len(documents), len(combined_texts))
+            if not combined_texts:
+                logger.info("No vectors to upsert. Skipping upsert.")
+                return True
+
+            embeddings = await self.embedding_service.aembed_batch(combined_texts)
+            vector_data = self._bulk_vector_data(documents, embeddings)
+
+            logger.info("Upserting %d vectors to Pinecone", len(vector_data))
+            result = await self.vector_store.aupsert_vectors(vector_data)
+            logger.info("Vector upsert result: %s", result)
             return result
 
         except Exception as e:
-            logger.error(f"Error adding document: {e}")
+            logger.error("Error adding documents: %s", e)
             logger.exception(e)
             return False
 
+    def _build_vector_data(self, chunks: List[str], embeddings: np.ndarray,
+                           metadata: Optional[Dict[str, Any]],
+                           ids: List[str], indices: List[int],
+                           content_hash: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Pair the chunks at indices with their embeddings, ids and per-chunk
+        metadata for upsert. content_hash (of the whole document) lets
+        update_document detect unchanged content.
+        """
+        debug = logger.isEnabledFor(logging.DEBUG)
+        base = dict(metadata) if metadata else {}
+        base["total_chunks"] = len(chunks)
+        if content_hash:
+            base["content_hash"] = content_hash
+        vector_data = []
+        for i, embedding in zip(indices, embeddings):
+            chunk, vector_id = chunks[i], ids[i]
+
+            vector_data.append({
+                "id": vector_id,
+                "values": embedding,
+                "metadata": {**base, "content": chunk, "chunk_index": i}
+            })
+            if debug:
+                logger.debug("Chunk %d/%d id=%s len=%d", i + 1, len(chunks), vector_id, len(chunk))
+        logger.info("Prepared %d vectors", len(vector_data))
+        return vector_data
+
+    def _build_context(self, similar_docs: List[Dict[str, Any]]) -> str:
+        """
+        Turn retrieved matches into the context block passed to the LLM.
+
+        Returns "" when nothing scores at least RAG_MIN_SCORE, so callers
+        answer NOT_FOUND_RESPONSE without an LLM round trip. Each match's
+        content is cut to max_doc_chars and the context to max_context_chars;
+        the entry that crosses the budget is truncated and later matches are
+        not formatted at all.
+        """
+        top_score = max((doc.get("score") or 0 for doc in similar_docs), default=0)
+        if top_score < self.settings.rag_min_score:
+            if similar_docs:
+                logger.debug("Top score %.3f below RAG_MIN_SCORE %.3f; skipping LLM",
+                            top_score, self.settings.rag_min_score)
+            return ""
+
+        budget = self.max_context_chars
+        doc_limit = self.max_doc_chars
+        context_parts = []
+        total = 0
+        for doc in similar_docs:
+            meta = doc.get("metadata", {})
+            if isinstance(meta, dict) and "content" in meta:
+                # Include relevant metadata in the context
+                metadata_info = []
+                if meta.get("patient_name"):
+                    metadata_info.append(f"Patient: {meta['patient_name']}")
+                if meta.get("patient_id"):
+                    metadata_info.append(f"Patient ID: {meta['patient_id']}")
+                if meta.get("date_time"):
+                    metadata_info.append(f"Date: {meta['date_time']}")
+                if meta.get("doctor"):
+                    metadata_info.append(f"Doctor: {meta['doctor']}")
+                
+                # Create a more informative context entry
+                context_entry = meta["content"][:doc_limit] if doc_limit > 0 else meta["content"]
+                if metadata_info:
+                    context_entry = f"[{', '.join(metadata_info)}] {context_entry}"
+                
+                if context_parts:
+                    total += 2  # "\n\n" separator
+                if budget > 0 and total + len(context_entry) > budget:
+                    if budget > total:
+                        context_parts.append(context_entry[:budget - total])
+                    logger.debug("Context budget of %d characters reached; truncating", budget)
+                    break
+                context_parts.append(context_entry)
+                total += len(context_entry)
+                logger.debug("Adding context from document ID: %s (score=%s)", doc.get("id", "N/A"), doc.get("score"))
+
+        context = "\n\n".join(context_parts)
+        logger.debug("Combined context length: %d", len(context))
+        logger.debug("Context passed to LLM: %s...", context[:500])  # Log first 500 chars of context
+        return context
+
+    @staticmethod
+    def _normalize_query(query_text: str) -> str:
+        return " ".join(query_text.split()).lower()
+
+    def _cached_query_embedding(self, query_text: str):
+        """
+        Returns (cache key, cached embedding or None)
+        """
+        key = self.query_embeddings.key(self._normalize_query(query_text))
+        embedding = self.query_embeddings.get(key)
+        if embedding is not None:
+            logger.debug(
+                "Query embedding cache hit (hits=%d, misses=%d)",
+                self.query_embeddings.hits, self.query_embeddings.misses
+            )
+        return key, embedding
+
+    def embed_query(self, query_text: str) -> np.ndarray:
+        """
+        Embed a user query, reusing the vector for repeated (normalized) queries
+        """
+        key, embedding = self._cached_query_embedding(query_text)
+        if embedding is None:
+            embedding = self.query_embeddings.put(key, self.embedding_service.get_embeddings([query_text])[0])
+        return embedding
+
+    async def aembed_query(self, query_text: str) -> np.ndarray:
+        """
+        Async variant of embed_query
+        """
+        key, embedding = self._cached_query_embedding(query_text)
+        if embedding is None:
+            embedding = self.query_embeddings.put(key, (await self.embedding_service.aget_embeddings([query_text]))[0])
+        return embedding
+
+    async def aembed_queries(self, query_texts: List[str]) -> List[np.ndarray]:
+        """
+        aembed_query for several queries: cache misses are embedded together,
+        one request per max-size batch.
+        """
+        lookups = [self._cached_query_embedding(text) for text in query_texts]
+        misses = [i for i, (_, embedding) in enumerate(lookups) if embedding is None]
+        step = self.embedding_service.max_batch_size
+        fetched = await asyncio.gather(*(
+            self.embedding_service.aget_embeddings([query_texts[i] for i in misses[s:s + step]])
+            for s in range(0, len(misses), step)
+        ))
+        embeddings = [embedding for _, embedding in lookups]
+        for i, embedding in zip(misses, (row for batch in fetched for row in batch)):
+            embeddings[i] = self.query_embeddings.put(lookups[i][0], embedding)
+        return embeddings
+
+    async def aquery_batch(self, query_texts: List[str], top_k: int = 3) -> List[str]:
+        """
+        Answer several queries concurrently: one batched embedding step, then
+        retrieval and generation for all queries gathered. Answers keep the
+        input order.
+        """
+        try:
+            embeddings = await self.aembed_queries(query_texts)
+        except Exception as e:
+            logger.error("Error embedding query batch: %s", e)
+            logger.exception(e)
+            return [QUERY_ERROR_RESPONSE] * len(query_texts)
+        return list(await asyncio.gather(*(
+            self.aquery(text, top_k, query_embedding=embedding)
+            for text, embedding in zip(query_texts, embeddings)
+        )))
+
     def query(self, query_text: str, top_k: int = 3) -> str:
+        """
+        Answer a query in one piece; see query_stream. Any failure, including
+        one partway through the stream, returns only QUERY_ERROR_RESPONSE.
+        """
         try:
-            logger.info(f"Processing query: '{query_text}' with top_k={top_k}")
-            logger.info(f"Embedding model used for QUERY: E5-Mistral-7B-Instruct")
+            return "".join(self.query_stream(query_text, top_k, raise_errors=True))
+        except Exception:
+            # Already logged by query_stream
+            return QUERY_ERROR_RESPONSE
+
+    def query_stream(self, query_text: str, top_k: int = 3, raise_errors: bool = False) -> Iterator[str]:
+        """
+        Answer a query, yielding the LLM output as it is generated.
+        A failure yields QUERY_ERROR_RESPONSE, possibly after partial output;
+        with raise_errors the exception propagates instead.
+        """
+        try:
+            logger.debug("Processing query: '%s' with top_k=%d", query_text, top_k)
             
             # Add timeout for embedding generation
-            import time
             start_time = time.time()
-            query_embedding = self.embedding_service.get_single_embedding(query_text)
+            query_embedding = self.embed_query(query_text)
             embedding_time = time.time() - start_time
-            logger.info(f"Embedding generation took {embedding_time:.2f} seconds")
-            logger.info(f"Query vector dimension: {len(query_embedding) if query_embedding else 0}")
+            logger.debug("Embedding generation took %.2f seconds", embedding_time)
+            logger.debug("Query vector dimension: %d", len(query_embedding))
 
             start_time = time.time()
-            similar_docs = self.vector_store.query_similar(query_embedding, top_k)
+            similar_docs = self._retrieve(query_embedding, top_k)
             query_time = time.time() - start_time
-            logger.info(f"Pinecone query took {query_time:.2f} seconds")
-            logger.info(f"Found {len(similar_docs)} similar documents")
-
-            context_parts = []
-            for doc in similar_docs:
-                meta = doc.get("metadata", {})
-                if isinstance(meta, dict) and "content" in meta:
-                    # Include relevant metadata in the context
-                    metadata_info = []
-                    if meta.get("patient_name"):
-                        metadata_info.append(f"Patient: {meta['patient_name']}")
-                    if meta.get("patient_id"):
-                        metadata_info.append(f"Patient ID: {meta['patient_id']}")
-                    if meta.get("date_time"):
-                        metadata_info.append(f"Date: {meta['date_time']}")
-                    if meta.get("doctor"):
-                        metadata_info.append(f"Doctor: {meta['doctor']}")
-                    
-                    # Create a more informative context entry
-                    context_entry = meta["content"]
-                    if metadata_info:
-                        context_entry = f"[{', '.join(metadata_info)}] {context_entry}"
-                    
-                    context_parts.append(context_entry)
-                    logger.info(f"Adding context from document ID: {doc.get('id', 'N/A')}")
-
-            context = "\n\n".join(context_parts)
-            logger.info(f"Combined context length: {len(context)}")
-            logger.info(f"Context passed to LLM: {context[:500]}...")  # Log first 500 chars of context
+            logger.debug("Pinecone query took %.2f seconds", query_time)
+            logger.debug("Found %d similar documents", len(similar_docs))
+
+            context = self._build_context(similar_docs)
+
+            if not context:
+                yield NOT_FOUND_RESPONSE
+                return
+
+            yield from self.llm_service.stream_response_with_context(context, query_text)
+
+        except Exception as e:
+            logger.error("Error querying RAG system: %s", e)
+            logger.exception(e)
+            if raise_errors:
+                raise
+            yield QUERY_ERROR_RESPONSE
+
+    async def aquery(self, query_text: str, top_k: int = 3,
+                     query_embedding: Optional[np.ndarray] = None) -> str:
+        """
+        Async variant of query; network calls go through the pooled client.
+        A precomputed query_embedding skips the embedding call.
+        """
+        try:
+            context = await self._aretrieve_context(query_text, top_k, query_embedding)
 
             if context:
-                response = self.llm_service.generate_response_with_context(context, query_text)
+                response = await self.llm_service.agenerate_response_with_context(context, query_text)
             else:
-                response = "I could not find this information in the patient's medical records."
-                
+                response = NOT_FOUND_RESPONSE
+
             return response
 
         except Exception as e:
-            logger.error(f"Error querying RAG system: {e}")
+            logger.error("Error querying RAG system: %s", e)
             logger.exception(e)
-            return "Sorry, an error occurred while processing your query."
+            return QUERY_ERROR_RESPONSE
+
+    async def aquery_stream(self, query_text: str, top_k: int = 3,
+                            query_embedding: Optional[np.ndarray] = None,
+                            raise_errors: bool = False) -> AsyncIterator[str]:
+        """
+        Streaming variant of aquery: yields the answer as the LLM produces it.
+        A failure yields QUERY_ERROR_RESPONSE, possibly after partial output;
+        with raise_errors the exception propagates instead so the caller can
+        tell a truncated answer from a complete one.
+        """
+        try:
+            context = await self._aretrieve_context(query_text, top_k, query_embedding)
+
+            if not context:
+                yield NOT_FOUND_RESPONSE
+                return
+
+            async for content in self.llm_service.astream_response_with_context(context, query_text):
+                yield content
+
+        except Exception as e:
+            logger.error("Error querying RAG system: %s", e)
+            logger.exception(e)
+            if raise_errors:
+                raise
+            yield QUERY_ERROR_RESPONSE
+
+    async def _aretrieve_context(self, query_text: str, top_k: int,
+                                 query_embedding: Optional[np.ndarray] = None) -> str:
+        """
+        Embed the query (unless precomputed), search Pinecone and build the context.
+        """
+        logger.debug("Processing query (async): '%s' with top_k=%d", query_text, top_k)
+
+        if query_embedding is None:
+            start_time = time.time()
+            query_embedding = await self.aembed_query(query_text)
+            logger.debug("Embedding generation took %.2f seconds", time.time() - start_time)
+
+        start_time = time.time()
+        similar_docs = await self._aretrieve(query_embedding, top_k)
+        logger.debug("Pinecone query took %.2f seconds", time.time() - start_time)
+        logger.debug("Found %d similar documents", len(similar_docs))
+
+        return self._build_context(similar_docs)
+
+    def _retrieve(self, query_embedding: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+        # Repeat query vectors are answered from the vector store's result cache
+        return self.vector_store.query_similar(query_embedding, top_k)
+
+    async def _aretrieve(self, query_embedding: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+        return await self.vector_store.aquery_similar(query_embedding, top_k)
+
+    @staticmethod
+    def _content_hash(content: str) -> str:
+        return hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _stored_metadata(fetched: Dict[str, Any], vector_id: str) -> Dict[str, Any]:
+        """
+        Metadata of a fetched vector (SDK object or dict), {} if it is missing.
+        """
+        vector = fetched.get(vector_id)
+        if vector is None:
+            return {}
+        meta = vector.get("metadata") if isinstance(vector, dict) else getattr(vector, "metadata", None)
+        return meta if isinstance(meta, dict) else {}
+
+    def _stale_ids(self, doc_id: str, existing: set, content: str) -> List[str]:
+        """
+        Chunk ids of doc_id that the new content no longer produces.
+        """
+        current = set(self._chunk_ids(self._chunk_text(content), None, doc_id))
+        return sorted(existing - current)
+
+    def _metadata_changes(self, stored: Dict[str, Any],
+                          metadata: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        For a document whose content is unchanged: the metadata fields to set
+        in place ({} if none differ), or None when the change alters the
+        header that is embedded with every chunk, so re-embedding is needed.
+        Reserved per-chunk keys in metadata are ignored.
+        """
+        changes = {
+            k: v for k, v in (metadata or {}).items()
+            if k not in RESERVED_METADATA_KEYS and stored.get(k) != v
+        }
+        if changes and self._build_metadata_header({**stored, **changes}) != self._build_metadata_header(stored):
+            return None
+        return changes
+
+    @staticmethod
+    def _stored_chunk_ids(doc_id: str, stored: Dict[str, Any]) -> List[str]:
+        return [f"{doc_id}-{i}" for i in range(int(stored.get("total_chunks", 1)))]
+
+    def _existing_chunk_ids(self, doc_id: str, listed: Optional[set], stored: Dict[str, Any]) -> set:
+        """
+        Stored chunk ids of doc_id: listed ids of the exact form "{doc_id}-{n}"
+        (the prefix listing also returns other documents, e.g. "{doc_id}-2023-0")
+        plus the range recorded in chunk 0's total_chunks. Raises when neither
+        is available, since stale chunks could then not be found.
+        """
+        if listed is None and "total_chunks" not in stored:
+            raise RuntimeError(f"Cannot determine the stored chunks of document {doc_id}")
+        pattern = re.compile(rf"{re.escape(doc_id)}-\d+")
+        existing = {vector_id for vector_id in listed or () if pattern.fullmatch(vector_id)}
+        if "total_chunks" in stored:
+            existing.update(self._stored_chunk_ids(doc_id, stored))
+        return existing
 
     def update_document(self, doc_id: str, content: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
-        self.vector_store.delete_vectors([doc_id])
-        return self.add_document(content, metadata)
+        """
+        Replace the chunks stored under doc_id ("{doc_id}-{chunk_index}").
+
+        Nothing is re-embedded when the stored content_hash matches: changed
+        metadata fields are then set in place on the existing chunks, unless
+        they change the embedded header. Otherwise the new chunks are upserted
+        first and chunks left over from a longer previous version are deleted
+        afterwards, so the document never disappears from search mid-update.
+        Raises RuntimeError, before writing anything, when the stored chunks
+        can be neither listed nor read from chunk 0's metadata.
+        """
+        first_chunk = f"{doc_id}-0"
+        stored = self._stored_metadata(self.vector_store.fetch_vectors([first_chunk]), first_chunk)
+        changes = None
+        if stored.get("content_hash") == self._content_hash(content):
+            changes = self._metadata_changes(stored, metadata)
+        if changes is not None:
+            if not changes:
+                logger.info("Document %s unchanged; skipping re-embed", doc_id)
+                return True
+            logger.info("Document %s content unchanged; updating metadata only", doc_id)
+            return self.vector_store.update_metadata(self._stored_chunk_ids(doc_id, stored), changes)
+
+        existing = self._existing_chunk_ids(doc_id, self.vector_store.list_ids(f"{doc_id}-"), stored)
+        if not self.add_document(content, metadata, doc_id=doc_id):
+            return False
+        stale = self._stale_ids(doc_id, existing, content)
+        if stale:
+            return self.vector_store.delete_vectors(stale)
+        return True
+
+    async def aupdate_document(self, doc_id: str, content: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Async variant of update_document
+        """
+        first_chunk = f"{doc_id}-0"
+        stored = self._stored_metadata(await self.vector_store.afetch_vectors([first_chunk]), first_chunk)
+        changes = None
+        if stored.get("content_hash") == self._content_hash(content):
+            changes = self._metadata_changes(stored, metadata)
+        if changes is not None:
+            if not changes:
+                logger.info("Document %s unchanged; skipping re-embed", doc_id)
+                return True
+            logger.info("Document %s content unchanged; updating metadata only", doc_id)
+            return await self.vector_store.aupdate_metadata(self._stored_chunk_ids(doc_id, stored), changes)
+
+        existing = self._existing_chunk_ids(doc_id, await self.vector_store.alist_ids(f"{doc_id}-"), stored)
+        if not await self.aadd_document(content, metadata, doc_id=doc_id):
+            return False
+        stale = self._stale_ids(doc_id, existing, content)
+        if stale:
+            return await self.vector_store.adelete_vectors(stale)
+        return True
@@ -5,8 +5,9 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
-# Add src directory to path
-sys.path.append(os.path.join(os.path.dirname(__file__)))
+# Import the top-level service modules next to this script, ahead of
+# anything else on sys.path, so there is only ever one copy in play
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from rag_service import RAGService
 
@@ -5,13 +5,32 @@ This script loads environment variables and fetches all vectors from the Pinecon
 """
 
 import os
-import json
+
+import orjson
 from dotenv import load_dotenv
 from pinecone import Pinecone
 
+from pinecone_service import match_as_dict
+
 # Load environment variables
 load_dotenv()
 
+# Zero query vectors by dimension, built once per process
+_ZERO_PROBES = {}
+
+def _zero_probe(dimension):
+    """Return the cached all-zeros query vector for a dimension"""
+    probe = _ZERO_PROBES.get(dimension)
+    if probe is None:
+        probe = _ZERO_PROBES[dimension] = [0.0] * dimension
+    return probe
+
+
+def _pretty(obj):
+    """Indented JSON for printing; non-JSON values fall back to str"""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY, default=str).decode()
+
+
 def get_all_pinecone_data():
     """Retrieve all data from Pinecone index"""
     
@@ -43,7 +62,7 @@ def get_all_pinecone_data():
     stats = {}
     try:
         stats = index.describe_index_stats()
-        print(f"📈 Index stats: {json.dumps(stats, indent=2, default=str)}")
+        print(f"📈 Index stats: {_pretty(stats)}")
     except Exception as e:
         print(f"⚠️ Could not fetch index stats: {e}")
     
@@ -56,7 +75,7 @@ def get_all_pinecone_data():
         
         # Create a simple query vector (all zeros)
         dimension = stats.get('dimension', 4096) if stats else 4096
-        query_vector = [0.0] * dimension
+        query_vector = _zero_probe(dimension)
         
         # Query for all vectors (high top_k)
         response = index.query(
@@ -66,12 +85,12 @@ def get_all_pinecone_data():
             include_values=False  # Set to True if you want to see the actual vector values
         )
         
-        # Access matches correctly
-        matches = []
+        # Access matches correctly, normalized once to plain dicts
         if isinstance(response, dict):
-            matches = response.get("matches", [])
+            raw_matches = response.get("matches", [])
         else:
-            matches = getattr(response, "matches", [])
+            raw_matches = getattr(response, "matches", [])
+        matches = [match_as_dict(m) for m in raw_matches]
         
         print(f"✅ Query successful. Found {len(matches)} matches")
         
@@ -79,13 +98,9 @@ def get_all_pinecone_data():
             print("\n📄 Retrieved vectors:")
             for i, match in enumerate(matches):
                 print(f"\n--- Vector {i+1} ---")
-                match_id = match.get("id") if isinstance(match, dict) else getattr(match, "id", "N/A")
-                match_score = match.get("score") if isinstance(match, dict) else getattr(match, "score", "N/A")
-                match_metadata = match.get("metadata", {}) if isinstance(match, dict) else getattr(match, "metadata", {})
-                
-                print(f"ID: {match_id}")
-                print(f"Score: {match_score}")
-                print(f"Metadata: {json.dumps(match_metadata, indent=2, default=str)}")
+                print(f"ID: {match['id']}")
+                print(f"Score: {match['score']}")
+                print(f"Metadata: {_pretty(match['metadata'])}")
         else:
             print("📭 No vectors found in the index")
             
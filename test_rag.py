@@ -1,8 +1,10 @@
 import os
 import json
+import time
 from pinecone import Pinecone
 import requests
 from dotenv import load_dotenv
+from pinecone_service import match_as_dict
 
 # Load environment variables
 load_dotenv()
@@ -16,6 +18,49 @@ SAMBANOVA_API_KEY = os.getenv("SAMBANOVA_API_KEY")
 EMBED_MODEL = os.getenv("EMBEDDING_MODEL", "E5-Mistral-7B-Instruct")  # Added default
 BASE_URL = "https://api.sambanova.ai/v1"
 
+# One keep-alive session for every request this script makes
+SESSION = requests.Session()
+
+# The index dimension never changes, so it is remembered between runs
+STATS_CACHE_PATH = os.path.expanduser("~/.cache/rag-llm-2/pinecone_stats.json")
+STATS_CACHE_TTL = 3600
+
+
+def get_index_dimension(index):
+    """
+    Index dimension from the on-disk cache when it is under an hour old,
+    otherwise from describe_index_stats (which is printed and cached).
+    Returns None if the stats call fails.
+    """
+    try:
+        if time.time() - os.path.getmtime(STATS_CACHE_PATH) < STATS_CACHE_TTL:
+            with open(STATS_CACHE_PATH) as f:
+                cached = json.load(f)
+            if cached.get("index") == INDEX_NAME and cached.get("dimension"):
+                print("\n📊 Index dimension from cache:", STATS_CACHE_PATH)
+                return cached["dimension"]
+    except (OSError, ValueError):
+        pass
+
+    try:
+        stats = index.describe_index_stats()
+        print("\n📊 Index Stats:")
+        # Safely convert to string representation
+        print(str(stats))
+    except Exception as e:
+        print(f"❌ Error getting index stats: {e}")
+        return None
+
+    index_dim = getattr(stats, 'dimension', 0) or 0
+    if index_dim:
+        try:
+            os.makedirs(os.path.dirname(STATS_CACHE_PATH), exist_ok=True)
+            with open(STATS_CACHE_PATH, "w") as f:
+                json.dump({"index": INDEX_NAME, "dimension": index_dim}, f)
+        except OSError as e:
+            print(f"⚠️ Could not cache index stats: {e}")
+    return index_dim
+
 
 # ----------------------------
 # 1. TEST SAMBANOVA EMBEDDINGS
@@ -42,7 +87,7 @@ def get_sambanova_embedding(text):
 
     print("\n🔵 Requesting embedding from SambaNova…")
 
-    res = requests.post(
+    res = SESSION.post(
         f"{BASE_URL}/embeddings",
         headers=headers,
         json=payload
@@ -84,24 +129,10 @@ def test_pinecone_query(embed):
         print(f"❌ Error connecting to Pinecone index: {e}")
         return
 
-    try:
-        stats = index.describe_index_stats()
-        print("\n📊 Index Stats:")
-        # Safely convert to string representation
-        print(str(stats))
-    except Exception as e:
-        print(f"❌ Error getting index stats: {e}")
+    index_dim = get_index_dimension(index)
+    if index_dim is None:
         return
 
-    # Get dimension from the stats - try multiple approaches
-    index_dim = 0
-    try:
-        # Try direct attribute access
-        index_dim = getattr(stats, 'dimension', 0)
-    except:
-        print("⚠️ Could not determine index dimension")
-        index_dim = 0
-        
     print(f"\n📌 Index dimension = {index_dim}")
 
     if index_dim != len(embed):
@@ -126,14 +157,9 @@ def test_pinecone_query(embed):
     # Safely convert response to string
     print(str(res))
 
-    # Access matches - try multiple approaches
-    matches = []
-    try:
-        # Try direct attribute access
-        matches = getattr(res, 'matches', [])
-    except:
-        print("⚠️ Could not access matches")
-        matches = []
+    # Normalize matches once to plain dicts
+    raw_matches = res.get("matches", []) if isinstance(res, dict) else getattr(res, "matches", [])
+    matches = [match_as_dict(m) for m in raw_matches]
 
     if not matches:
         print("\n⚠️ No matches found!")
@@ -146,7 +172,7 @@ def test_pinecone_query(embed):
         for m in matches:
             print(f"\nID: {m['id']}")
             print(f"Score: {m['score']}")
-            print("Content:", m['metadata'].get("content", "")[:200], "...")
+            print("Content:", (m['metadata'] or {}).get("content", "")[:200], "...")
 
 
 # ----------------------------
@@ -1,5 +1,6 @@
 import os
 import sys
+import numpy as np
 from dotenv import load_dotenv
 
 # Add the current directory to the Python path
@@ -14,11 +15,14 @@ def test_pinecone_connection():
         from pinecone_service import PineconeService
         pinecone_service = PineconeService()
         print("✓ Pinecone service initialized successfully")
+
+        # One float32 probe for both calls; the service converts it at the SDK boundary
+        probe = np.full(pinecone_service.dimension, 0.1, dtype=np.float32)
         
         # Test upsert
         test_vectors = [{
             "id": "test-vector-1",
-            "values": [0.1] * 4096,  # 4096-dimensional vector
+            "values": probe,
             "metadata": {"content": "This is a test document"}
         }]
         
@@ -29,8 +33,7 @@ def test_pinecone_connection():
             print("✗ Vector upsert failed")
             
         # Test query
-        query_vector = [0.1] * 4096
-        results = pinecone_service.query_similar(query_vector, top_k=1)
+        results = pinecone_service.query_similar(probe, top_k=1)
         print(f"✓ Vector query returned {len(results)} results")
         
         # Clean up